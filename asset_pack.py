@@ -0,0 +1,97 @@
+import os
+import json
+import mmap
+import struct
+import pygame
+
+# file: MAGIC, VERSION, index size, index json, then aligned data blocks
+# images are stored already decoded as RGBA pixels
+
+MAGIC = b"GOSP"
+VERSION = 1
+HEADER = struct.Struct('<4sBI')
+ALIGN = 16
+
+FILE_PATH_PACK = "assets.pak"
+
+
+class AssetPack:
+    def __init__(self, path):
+        self.file = open(path, 'rb')
+        self.mmap = mmap.mmap(self.file.fileno(), 0, access=mmap.ACCESS_READ)
+        magic, version, index_size = HEADER.unpack_from(self.mmap, 0)
+        if magic != MAGIC or version != VERSION:
+            raise ValueError("not a supported asset pack: " + path)
+        start = HEADER.size
+        self.index = json.loads(self.mmap[start:start + index_size].decode('utf-8'))
+
+    def __contains__(self, name):
+        return name in self.index
+
+    def get_bytes(self, name):
+        entry = self.index[name]
+        return memoryview(self.mmap)[entry["offset"]:entry["offset"] + entry["size"]]
+
+    def load_image(self, name):
+        entry = self.index[name]
+        return pygame.image.frombuffer(self.get_bytes(name), (entry["width"], entry["height"]), "RGBA")
+
+    def load_data(self, name):
+        return json.loads(bytes(self.get_bytes(name)).decode('utf-8'))
+
+
+def open_pack(path=FILE_PATH_PACK):
+    # loose files are used when there is no pack
+    if not os.path.isfile(path):
+        return None
+    return AssetPack(path)
+
+
+def build_pack(path, images_dir="images", levels_dir="levels", default_settings=None):
+    blocks = []
+    for root, dirs, files in os.walk(images_dir):
+        dirs.sort()
+        for file in sorted(files):
+            if file.endswith(".png"):
+                full_path = os.path.join(root, file)
+                image = pygame.image.load(full_path)
+                name = os.path.relpath(full_path, images_dir).replace(os.sep, "/")
+                entry = {"kind": "image", "width": image.get_width(), "height": image.get_height()}
+                blocks.append(("images/" + name, entry, pygame.image.tostring(image, "RGBA")))
+    for file in sorted(os.listdir(levels_dir)):
+        if file.endswith(".json"):
+            with open(os.path.join(levels_dir, file), 'rb') as f:
+                data = f.read()
+            json.loads(data.decode('utf-8'))
+            blocks.append(("levels/" + file, {"kind": "data"}, data))
+    if default_settings is not None:
+        blocks.append(("settings.json", {"kind": "data"}, json.dumps(default_settings).encode('utf-8')))
+
+    # offsets depend on the index size, so index is made until it stops changing
+    index = {}
+    index_data = b""
+    while True:
+        offset = HEADER.size + len(index_data)
+        for name, entry, data in blocks:
+            offset += -offset % ALIGN
+            index[name] = dict(entry, offset=offset, size=len(data))
+            offset += len(data)
+        new_index_data = json.dumps(index, sort_keys=True).encode('utf-8')
+        size_changed = len(new_index_data) != len(index_data)
+        index_data = new_index_data
+        if not size_changed:
+            break
+
+    with open(path, 'wb') as f:
+        f.write(HEADER.pack(MAGIC, VERSION, len(index_data)) + index_data)
+        for name, entry, data in blocks:
+            f.write(b"\0" * (index[name]["offset"] - f.tell()))
+            f.write(data)
+    return index
+
+
+if __name__ == "__main__":
+    from file_import import default_settings
+
+    pack_index = build_pack(FILE_PATH_PACK, default_settings=default_settings)
+    print(f"{FILE_PATH_PACK}: {len(pack_index)} assets, {os.path.getsize(FILE_PATH_PACK)} bytes")
@@ -0,0 +1,110 @@
+import os
+import json
+import pygame
+
+from file_import import save_data, load_data
+from surface_optimizer import SURFACE_KINDS, classify_surface, pick_colorkey, with_colorkey
+
+
+def pack_shelves(sizes, page_size, padding=1):
+    # sizes is {name: (w, h)}, returns {name: (page, x, y)}
+    # images are placed in rows, the highest first
+    page_w, page_h = page_size
+    layout = {}
+    page, x, y, shelf_h = 0, 0, 0, 0
+    for name in sorted(sizes, key=lambda name: (-sizes[name][1], -sizes[name][0], name)):
+        w, h = sizes[name]
+        if w > page_w or h > page_h:
+            raise ValueError(f"image {name} {w}x{h} does not fit into atlas page")
+        if x + w > page_w:
+            x, y = 0, y + shelf_h + padding
+            shelf_h = 0
+        if y + h > page_h:
+            page, x, y, shelf_h = page + 1, 0, 0, 0
+        layout[name] = (page, x, y)
+        x += w + padding
+        shelf_h = max(shelf_h, h)
+    return layout
+
+
+class Atlas:
+    def __init__(self, page_size=(512, 512), layout_path=None):
+        self.page_size = page_size
+        self.layout_path = layout_path
+        self.pages = []
+        self.page_kinds = []
+
+    def load_layout(self, sizes):
+        # sizes is {name: (w, h, kind)}
+        # cached layout is used only if it was made for the same images
+        if self.layout_path is None or not os.path.isfile(self.layout_path):
+            return None
+        try:
+            data = load_data(self.layout_path)
+            if data["page_size"] != list(self.page_size):
+                return None
+            entries = data["entries"]
+            if {name: tuple(entry[:3]) for name, entry in entries.items()} != sizes:
+                return None
+            return {name: tuple(entry[3:]) for name, entry in entries.items()}
+        except (json.decoder.JSONDecodeError, KeyError, TypeError, ValueError):
+            return None
+
+    def save_layout(self, sizes, layout):
+        if self.layout_path is None:
+            return
+        entries = {name: [*sizes[name], *layout[name]] for name in sizes}
+        save_data({"page_size": list(self.page_size), "entries": entries}, self.layout_path)
+
+    def build(self, images):
+        # images is {name: Surface}, returns {name: subsurface of an atlas page}
+        # a page has images of one kind, so opaque and colorkey images are not blitted with alpha
+        sizes = {name: (*image.get_size(), classify_surface(image)) for name, image in images.items()}
+        layout = self.load_layout(sizes)
+        if layout is None:
+            layout = {}
+            pages_count = 0
+            for kind in SURFACE_KINDS:
+                kind_sizes = {name: size[:2] for name, size in sizes.items() if size[2] == kind}
+                for name, (page, x, y) in pack_shelves(kind_sizes, self.page_size).items():
+                    layout[name] = (pages_count + page, x, y)
+                pages_count = max((layout[name][0] + 1 for name in kind_sizes), default=pages_count)
+            self.save_layout(sizes, layout)
+
+        pages_count = max((page for page, x, y in layout.values()), default=-1) + 1
+        # a page is only as big as the images on it, page_size is the limit for packing
+        page_sizes = [(0, 0)] * pages_count
+        for name, (page, x, y) in layout.items():
+            w, h = sizes[name][:2]
+            page_sizes[page] = (max(page_sizes[page][0], x + w), max(page_sizes[page][1], y + h))
+        self.pages = []
+        self.page_kinds = ["alpha"] * pages_count
+        for page_size in page_sizes:
+            page = pygame.Surface(page_size, pygame.SRCALPHA, 32).convert_alpha()
+            page.fill((0, 0, 0, 0))
+            self.pages.append(page)
+        for name, image in images.items():
+            page, x, y = layout[name]
+            self.page_kinds[page] = sizes[name][2]
+            # max blend over transparent page copies pixels with their alpha
+            self.pages[page].blit(image, (x, y), special_flags=pygame.BLEND_RGBA_MAX)
+
+        keys = [None] * pages_count
+        for i, kind in enumerate(self.page_kinds):
+            if kind == "opaque":
+                self.pages[i] = self.pages[i].convert()
+            elif kind == "colorkey":
+                keys[i] = pick_colorkey(self.pages[i])
+                if keys[i] is None:
+                    self.page_kinds[i] = "alpha"
+                else:
+                    self.pages[i] = with_colorkey(self.pages[i], keys[i])
+
+        result = {}
+        for name in images:
+            page, x, y = layout[name]
+            result[name] = self.pages[page].subsurface((x, y, *sizes[name][:2]))
+            if keys[page] is not None:
+                # pages are never blitted, only the subsurfaces are run length encoded
+                result[name].set_colorkey(keys[page], pygame.RLEACCEL)
+        return result
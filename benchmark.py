@@ -0,0 +1,405 @@
+import os
+import random
+import argparse
+import tracemalloc
+from time import perf_counter, process_time
+from collections import Counter
+
+repeats = 5
+
+os.environ["SDL_VIDEODRIVER"] = "dummy"
+
+import main
+from surface_optimizer import classify_surface, alpha_copy
+
+
+def random_states(steps, seed=1):
+    # held keys with random lengths, some jumps and dashes, the same for every run
+    rnd = random.Random(seed)
+    states = []
+    state, left = 0, 0
+    for i in range(steps):
+        if left == 0:
+            state = rnd.getrandbits(6)
+            left = rnd.randint(1, 60)
+            if rnd.random() < 0.3:
+                state |= main.EVENT_JUMP
+            if rnd.random() < 0.1:
+                state |= main.EVENT_DASH
+        else:
+            state &= 63
+        left -= 1
+        states.append(state)
+    return states
+
+
+def run_player(scene, states):
+    player = scene.player
+    for state in states:
+        scene.keys = main.KeyState(state)
+        if state & main.EVENT_JUMP:
+            player.jump_mercy = main.jump_mercy
+        if state & main.EVENT_DASH:
+            player.dash()
+        player.update()
+
+
+class ReferencePlayer(main.PlayerSprite):
+    # player step as it was before the allocation free one: collisions in a new dict every step,
+    # varargs checks, approach calls and rect tuples unpacked for every wall
+    def collision_all(self, *collides):
+        for collide in collides:
+            if not self.collisions[collide]:
+                return False
+        return True
+
+    def collision_any(self, *collides):
+        for collide in collides:
+            if self.collisions[collide]:
+                return True
+        return False
+
+    def jump(self):
+        if self.jump_can:
+            if self.jump_ground_w == 0:
+                self.jump_can = False
+                self.jump_pressed_w = main.jump_pressed_w
+                self.vy = main.jump_force
+                return True
+        elif self.collision_any(main.COLLIDE_RIGHT, main.COLLIDE_LEFT):
+            xd = 1 if self.collisions[main.COLLIDE_LEFT] else -1
+            self.vx = main.wall_jump_x * xd
+            self.vy = main.wall_jump_y
+            self.hooked = False
+            self.hook_not_w = main.hook_not_w
+            return True
+        else:
+            if self.jump_mercy == 0:
+                self.jump_mercy = main.jump_mercy
+        return False
+
+    def update(self):
+        self.check_collides()
+        self.check_triggers()
+        self.keys = self.read_keys()
+
+        self.jump_ground_w = main.approach(self.jump_ground_w, 0, main.dt)
+        self.jump_pressed_w = main.approach(self.jump_pressed_w, 0, main.dt)
+        if self.dash_w > 0:
+            self.dash_w = main.approach(self.dash_w, 0, main.dt)
+            if not self.dash_w > 0:
+                self.vy = main.dash_end_y_force * main.sign(self.vy)
+        self.hook_not_w = main.approach(self.hook_not_w, 0, main.dt)
+
+        if self.collisions[main.COLLIDE_DOWN]:
+            self.jump_can = True
+            if self.dash_w == 0:
+                self.can_dash = True
+            if self.vy < 0:
+                self.jump_ground_w = main.jump_ground_w
+
+        if self.keys[main.KEY_JUMP] and self.jump_pressed_w > 0:
+            self.vy += main.jump_pressed_force * main.dt
+        else:
+            self.jump_pressed_w = 0
+
+        self.check_hook()
+
+        self.move_y()
+        self.move_x()
+
+        if self.jump_mercy > 0:
+            if self.jump():
+                self.jump_mercy = 0
+            else:
+                self.jump_mercy = main.approach(self.jump_mercy, 0, main.dt)
+
+        self.check_stops()
+        self.move()
+
+        self.collect_coins()
+
+        if self.scene.group_spikes.collide(self.rect):
+            self.die()
+
+    def check_collides(self):
+        collisions = {
+            main.COLLIDE_UP: False,
+            main.COLLIDE_DOWN: False,
+            main.COLLIDE_LEFT: False,
+            main.COLLIDE_RIGHT: False,
+            main.COLLIDE_HOOK_UP: False,
+            main.COLLIDE_HOOK_DOWN: False,
+        }
+        r1 = self.rect
+        # level rects in level order, as group_walls had them before merging
+        for r2 in self.scene.wall_rects["colliders"]:
+            x11, y11 = r1.topleft
+            w1, h1 = r1.size
+            x12, y12 = x11 + w1, y11 + h1
+
+            x21, y21 = r2.topleft
+            w2, h2 = r2.size
+            x22, y22 = x21 + w2, y21 + h2
+
+            collide_x = x11 <= x22 and x12 >= x21
+            collide_y = y11 <= y22 and y12 >= y21
+            if not (collide_x and collide_y):
+                continue
+
+            some_collide_x = min(abs(x12 - x21), abs(x11 - x22)) < main.max_collide_pixels
+            some_collide_y = min(abs(y12 - y21), abs(y11 - y22)) < main.max_collide_pixels
+
+            if collide_y and not some_collide_x:
+                if y11 >= y21 + h2 / 2:
+                    collisions[main.COLLIDE_DOWN] = True
+                    self.y += y22 - y11
+                else:
+                    collisions[main.COLLIDE_UP] = True
+                    self.y += y21 - y12
+            if collide_x and not some_collide_y:
+                if x11 >= x21 + w2 / 2:
+                    collisions[main.COLLIDE_LEFT] = True
+                    self.x += x22 - x11
+                else:
+                    collisions[main.COLLIDE_RIGHT] = True
+                    self.x += x21 - x12
+            if not y11 + h1 * 2 / 3 > y22:
+                collisions[main.COLLIDE_HOOK_UP] = True
+            if not y11 + h1 / 3 < y21:
+                collisions[main.COLLIDE_HOOK_DOWN] = True
+        self.collisions = collisions
+
+    def check_hook(self):
+        if self.dash_w != 0:
+            return
+        if self.hooked:
+            if self.hook_right:
+                if not self.collisions[main.COLLIDE_RIGHT]:
+                    self.hooked = False
+            else:
+                if not self.collisions[main.COLLIDE_LEFT]:
+                    self.hooked = False
+            if not self.collision_all(main.COLLIDE_HOOK_DOWN, main.COLLIDE_HOOK_UP):
+                self.hooked = False
+                if not self.vy < 0:
+                    self.vy = 260
+
+        if self.keys[main.KEY_HOOK] != self.hooked:
+            if self.hooked:
+                self.hooked = False
+            else:
+                if self.hook_not_w == 0 and self.collision_any(main.COLLIDE_LEFT, main.COLLIDE_RIGHT) and \
+                        self.collision_all(main.COLLIDE_HOOK_DOWN, main.COLLIDE_HOOK_UP):
+                    self.hooked = True
+                    self.vy = 0
+                    self.hook_right = self.collisions[main.COLLIDE_RIGHT]
+
+        if self.hooked and self.hook_not_w == 0:
+            if self.keys[main.KEY_UP]:
+                self.vy = main.hook_move_force
+            elif self.keys[main.KEY_DOWN]:
+                self.vy = -main.hook_move_force
+            else:
+                self.vy = 0
+
+    def move_y(self):
+        if not ((self.hooked and self.hook_not_w == 0) or self.dash_w != 0):
+            if not self.collisions[main.COLLIDE_DOWN]:
+                self.vy -= main.gravity * main.dt
+                if self.vy < -main.max_gravity:
+                    self.vy = -main.max_gravity
+                self.jump_can = False
+
+    def move_x(self):
+        if self.hooked or self.dash_w > 0:
+            return
+
+        mult = 1 if self.collisions[main.COLLIDE_DOWN] else main.friction_air
+
+        key_x = 0
+        if self.keys[main.KEY_RIGHT]:
+            key_x = 1
+        elif self.keys[main.KEY_LEFT]:
+            key_x = -1
+
+        if abs(self.vx) > main.max_move and main.sign(self.vx) == key_x:
+            self.vx = main.approach(self.vx, main.max_move * key_x, main.friction_reduce * mult * main.dt)
+        else:
+            self.vx = main.approach(self.vx, main.max_move * key_x, main.friction_accel * mult * main.dt)
+
+    def check_stops(self):
+        if self.collisions[main.COLLIDE_UP]:
+            if self.vy > 0:
+                self.vy = 0
+        if self.collisions[main.COLLIDE_DOWN]:
+            if self.vy < 0:
+                self.vy = 0
+        if self.collisions[main.COLLIDE_RIGHT]:
+            if self.vx > 0:
+                self.vx = 0
+        if self.collisions[main.COLLIDE_LEFT]:
+            if self.vx < 0:
+                self.vx = 0
+
+
+def time_player(scene, states, checkpoint):
+    best = float("inf")
+    for i in range(repeats):
+        checkpoint.restore(scene)
+        start = perf_counter()
+        run_player(scene, states)
+        best = min(best, perf_counter() - start)
+    player = scene.player
+    return best, (player.x, player.y, player.vx, player.vy)
+
+
+def player_memory(scene, states, checkpoint):
+    # key states are made before measuring, so only the player step is counted
+    checkpoint.restore(scene)
+    keys = [main.KeyState(state & 63) for state in states]
+    player = scene.player
+    tracemalloc.start()
+    before = tracemalloc.get_traced_memory()[0]
+    tracemalloc.reset_peak()
+    for key_state in keys:
+        scene.keys = key_state
+        player.update()
+    current, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    return (current - before) / len(states), peak - before
+
+
+def bench_player(steps):
+    # the step is compared with the reference one on the same input, both must end in the same state
+    scene = main.GameScene(headless=True)
+    # triggers load levels and take checkpoints, they are not a part of the step
+    scene.group_triggers.clear()
+    scene.player.dash_skill = True
+    states = random_states(steps)
+    checkpoint = main.WorldSnapshot(scene)
+
+    time, end = time_player(scene, states, checkpoint)
+    kept, peak = player_memory(scene, states, checkpoint)
+    scene.player.__class__ = ReferencePlayer
+    reference_time, reference_end = time_player(scene, states, checkpoint)
+    reference_kept, reference_peak = player_memory(scene, states, checkpoint)
+    scene.player.__class__ = main.PlayerSprite
+
+    print(f"player step: {steps} steps, {steps / reference_time:.0f} steps/s before, {steps / time:.0f} steps/s now, "
+          f"x{reference_time / time:.2f}, same end state: {end == reference_end}")
+    print(f"player step memory: {reference_kept:.2f} B kept per step and {reference_peak} B peak before, "
+          f"{kept:.2f} B kept per step and {peak} B peak now")
+
+
+def time_blits(images, rounds):
+    best = float("inf")
+    for i in range(repeats):
+        start = perf_counter()
+        for j in range(rounds):
+            for image in images:
+                main.screen.blit(image, (0, 0))
+        best = min(best, perf_counter() - start)
+    return best / rounds / len(images)
+
+
+def bench_blit(steps):
+    # images of every sprite type compared with per-pixel alpha copies, as all images were before
+    scene = main.GameScene(headless=True)
+    images = {}
+    for level_name in main.leak_check_levels:
+        scene.load_level(level_name)
+        for sprite in scene.group_all:
+            images.setdefault(type(sprite).__name__, []).append(sprite.image)
+
+    for name, sprite_images in sorted(images.items()):
+        rounds = max(steps // 10 // len(sprite_images), 1)
+        kinds = Counter(classify_surface(image) for image in sprite_images)
+        alpha_time = time_blits([alpha_copy(image) for image in sprite_images], rounds)
+        time = time_blits(sprite_images, rounds)
+        kinds_text = ", ".join(f"{count} {kind}" for kind, count in sorted(kinds.items()))
+        print(f"blit {name}: {kinds_text}, {alpha_time * 1e6:.1f} us with alpha, {time * 1e6:.1f} us now, "
+              f"x{alpha_time / time:.2f}")
+
+
+def time_cannons(scene, batteries, steps):
+    # bullets are removed every step, so only the cannons are measured
+    best = float("inf")
+    for i in range(repeats):
+        start = perf_counter()
+        for j in range(steps):
+            for battery in batteries:
+                battery.update()
+            del scene.group_all.layers["others"][len(batteries):]
+            scene.group_bullets.clear()
+        best = min(best, perf_counter() - start)
+    return best
+
+
+def bench_cannons(steps, grid=(20, 10)):
+    # one battery of a grid compared with a battery for every barrel, as every cannon was a sprite before
+    scene = main.GameScene(headless=True)
+    data = [600, 200, 1.5, 1]
+    size = list(main.cannon_size)
+    barrels = grid[0] * grid[1]
+    results = []
+    for xy in (grid, (1, 1)):
+        scene.group_all.clear()
+        scene.group_cannons.clear()
+        random.seed(1)
+        for x in range(grid[0] // xy[0]):
+            for y in range(grid[1] // xy[1]):
+                main.CannonBattery(scene, [size[0] * x, size[1] * y], size, 90, data, xy)
+        batteries = list(scene.group_cannons)
+        results.append((len(batteries), time_cannons(scene, batteries, steps)))
+    (one, time), (many, many_time) = results
+    print(f"cannons: {barrels} barrels, {steps} steps, {many} sprites {many_time / steps * 1e6:.1f} us/step, "
+          f"{one} battery {time / steps * 1e6:.1f} us/step, x{many_time / time:.2f}")
+
+
+def cpu_load(tick, seconds):
+    # share of one core used by the loop
+    start, start_cpu = perf_counter(), process_time()
+    while perf_counter() - start < seconds:
+        tick()
+    return (process_time() - start_cpu) / (perf_counter() - start)
+
+
+def bench_idle(steps):
+    # the game loop with active, unfocused and minimized window, and the end screen
+    seconds = steps / 10000
+    scene = main.GameScene()
+    scene.group_triggers.clear()
+    loads = []
+    for state, events in (("active", ()), ("unfocused", (main.pygame.WINDOWFOCUSLOST,)),
+                          ("minimized", (main.pygame.WINDOWMINIMIZED,))):
+        for event in events:
+            main.pygame.event.post(main.pygame.event.Event(event))
+        loads.append((state, cpu_load(scene.tick, seconds)))
+    for event in (main.pygame.WINDOWRESTORED, main.pygame.WINDOWFOCUSGAINED):
+        main.pygame.event.post(main.pygame.event.Event(event))
+    scene.tick()
+    loads.append(("end screen", cpu_load(main.EndScene().tick, seconds)))
+
+    active = loads[0][1]
+    for state, load in loads:
+        print(f"cpu {state}: {load * 100:.1f}% of a core, {load / active * 100:.0f}% of the active game")
+
+
+benchmarks = {
+    "player": bench_player,
+    "blit": bench_blit,
+    "cannons": bench_cannons,
+    "idle": bench_idle,
+}
+
+if __name__ == "__main__":
+    arg_parser = argparse.ArgumentParser(description="God of Sky benchmarks")
+    arg_parser.add_argument("name", nargs="*", help="benchmarks to run, all by default: " + ", ".join(benchmarks))
+    arg_parser.add_argument("--steps", type=int, default=20000)
+    args = arg_parser.parse_args()
+    for name in args.name:
+        if name not in benchmarks:
+            arg_parser.error("unknown benchmark: " + name)
+    for name in args.name or benchmarks:
+        benchmarks[name](args.steps)
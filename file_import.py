@@ -1,13 +1,18 @@
+import os
 import json
 import pygame
 
+from asset_pack import open_pack
+
 
 def save_data(data, path):
-    json.dump(data, open(path, 'w', encoding='utf-8'))
+    with open(path, 'w', encoding='utf-8') as f:
+        json.dump(data, f)
 
 
 def load_data(path) -> dict:
-    data = json.load(open(path, 'r', encoding='utf-8'))
+    with open(path, 'r', encoding='utf-8') as f:
+        data = json.load(f)
     if not isinstance(data, dict):
         raise json.decoder.JSONDecodeError
     return data
@@ -15,6 +20,8 @@ def load_data(path) -> dict:
 
 FILE_PATH_SETTINGS = "settings.json"
 
+asset_pack = open_pack()
+
 default_settings = {
     "keys": {
         "up": pygame.K_UP,
@@ -27,8 +34,14 @@ default_settings = {
     }
 }
 
+if asset_pack is not None and FILE_PATH_SETTINGS in asset_pack:
+    default_settings = asset_pack.load_data(FILE_PATH_SETTINGS)
+
 error = False
 try:
+    if asset_pack is not None and not os.path.isfile(FILE_PATH_SETTINGS):
+        # first start, settings from the pack are already valid
+        save_data(default_settings, FILE_PATH_SETTINGS)
     settings = load_data(FILE_PATH_SETTINGS)
     st_keys = settings["keys"]
 
@@ -0,0 +1,88 @@
+import pygame
+
+from pacing import perf_counter_ns
+
+
+class InputQueue:
+    # key events with their times, turned into one input state per physics substep
+    def __init__(self, key_bits, press_bits, capacity=256):
+        self.key_bits = key_bits
+        self.press_bits = press_bits
+        self.capacity = capacity
+        self.times = [0] * capacity
+        self.keys = [0] * capacity
+        self.downs = [False] * capacity
+        self.exact = [False] * capacity
+        self.head = 0
+        self.size = 0
+        self.overflows = 0
+
+        self.events = []
+        self.held = 0
+        self.frame_start = perf_counter_ns()
+        self.press_times = []
+
+    def sync(self, keys):
+        # held keys from pygame.key.get_pressed(), for start and lost focus
+        self.held = 0
+        for key, bit in self.key_bits.items():
+            if keys[key]:
+                self.held |= bit
+
+    def drain(self, exact=True):
+        # exact is false when events could wait long in SDL queue, they are put to the first substep
+        now = perf_counter_ns()
+        for event in pygame.event.get():
+            if event.type in (pygame.KEYDOWN, pygame.KEYUP) and \
+                    (event.key in self.key_bits or event.key in self.press_bits):
+                self.push(now, event.key, event.type == pygame.KEYDOWN, exact)
+            else:
+                self.events.append(event)
+
+    def push(self, time, key, down, exact=True):
+        if self.size == self.capacity:
+            self.overflows += 1
+            return
+        i = (self.head + self.size) % self.capacity
+        self.times[i] = time
+        self.keys[i] = key
+        self.downs[i] = down
+        self.exact[i] = exact
+        self.size += 1
+
+    def take_events(self):
+        events = self.events
+        self.events = []
+        return events
+
+    def frame(self, substeps):
+        # events of the last frame are spread over substeps of the next one by their time
+        start = self.frame_start
+        end = self.frame_start = perf_counter_ns()
+        length = max(end - start, 1)
+        self.press_times = []
+
+        states = []
+        for substep in range(substeps):
+            pressed = 0
+            while self.size:
+                time = self.times[self.head]
+                if self.exact[self.head]:
+                    event_i = min(max((time - start) * substeps // length, 0), substeps - 1)
+                else:
+                    event_i = 0
+                if event_i > substep:
+                    break
+                key = self.keys[self.head]
+                bit = self.key_bits.get(key, 0)
+                if self.downs[self.head]:
+                    self.held |= bit
+                    pressed |= bit | self.press_bits.get(key, 0)
+                    self.press_times.append(time)
+                else:
+                    self.held &= ~bit
+                self.head = (self.head + 1) % self.capacity
+                self.size -= 1
+            # key pressed and released in one substep is still seen
+            states.append(self.held | pressed)
+        return states
@@ -1,10 +1,32 @@
+from time import perf_counter
+# start of the process, the first frame time is measured from it, so it is never reset
+start_time = perf_counter()
+
 import os
+import atexit
+import json
+import random
+import argparse
+import threading
+import tracemalloc
 from sys import exit
+from array import array
+from collections import deque
+from itertools import chain
+from concurrent.futures import ThreadPoolExecutor, wait
 
 from random import randint
-from pygame.transform import scale, rotate
+from pygame.transform import scale, rotate, smoothscale
 
 from file_import import *
+from rect_merge import merge_rects
+from atlas import Atlas
+from surface_optimizer import optimize_surface, alpha_copy
+from replay import InputRecorder, InputReader, EVENT_JUMP, EVENT_DASH
+from pacing import FramePacer, PACING_POLICIES
+from input_queue import InputQueue
+from window_activity import WindowActivity
+from memstats import SurfaceTracker, count_instances, take_snapshot, snapshot_diff, format_report
 
 
 def sign(x):
@@ -15,11 +37,41 @@ def sign(x):
     return -1
 
 
-def load_image(path, color_key=None):
+def decode_image(path):
+    # can be called from loader threads, pixel format is not converted
+    pack_name = "images/" + path
+    if asset_pack is not None and pack_name in asset_pack:
+        return asset_pack.load_image(pack_name)
     path = os.path.join("images", path)
     if not os.path.isfile(path):
         raise FileExistsError("file not found: " + path)
-    image = pygame.image.load(path)
+    return pygame.image.load(path)
+
+
+class AssetLoader:
+    def __init__(self, workers=4):
+        self.executor = ThreadPoolExecutor(workers, thread_name_prefix="asset")
+        self.futures = {}
+
+    def request(self, path):
+        if path not in self.futures:
+            self.futures[path] = self.executor.submit(decode_image, path)
+        return self.futures[path]
+
+    def request_all(self, paths):
+        for path in paths:
+            self.request(path)
+
+    def ready(self, path):
+        return path in self.futures and self.futures[path].done()
+
+    def get(self, path):
+        # waits only if the image is not decoded yet
+        return self.request(path).result()
+
+
+def load_image(path, color_key=None):
+    image = asset_loader.get(path)
     if color_key is not None:
         image = image.convert()
         if color_key == -1:
@@ -30,6 +82,25 @@ def load_image(path, color_key=None):
     return image
 
 
+def get_level_path(level_name):
+    return "levels/" + level_name + ".json"
+
+
+def load_level_data(level_name, loose=False):
+    # loose is used in dev mode, so edited files are read instead of the pack
+    path = get_level_path(level_name)
+    if not loose and asset_pack is not None and path in asset_pack:
+        return asset_pack.load_data(path)
+    return load_data(path)
+
+
+def get_level_mtime(level_name):
+    try:
+        return os.stat(get_level_path(level_name)).st_mtime_ns
+    except OSError:
+        return None
+
+
 def approach(value, mx, step):
     if abs(value - mx) <= step:
         return mx
@@ -39,13 +110,85 @@ def approach(value, mx, step):
         return value + step
 
 
-def screen_draw():
-    scale_ = min(window_width / width, window_height / height)
-    dx = (window_width - width * scale_) // 2
-    dy = (window_height - height * scale_) // 2
-    window.blit(scale(screen, (width * scale_, height * scale_)), (dx, dy))
+def scale_frame(surface, window_size):
+    # does not touch the window, so it can be called from the presenter thread
+    window_w, window_h = window_size
+    scale_ = min(window_w / width, window_h / height)
+    dx = (window_w - width * scale_) // 2
+    dy = (window_h - height * scale_) // 2
+    scale_func = smoothscale if governor.smooth_scaling() else scale
+    return scale_func(surface, (width * scale_, height * scale_)), (dx, dy)
+
+
+def present_frame(image, pos):
+    # SDL video calls are safe only in the main thread
+    window.blit(image, pos)
     pygame.display.flip()
 
+    global first_frame_time
+    if first_frame_time is None:
+        first_frame_time = perf_counter() - start_time
+        if args.timing_report:
+            print(f"first frame after {first_frame_time * 1000:.0f} ms")
+
+
+def screen_draw():
+    present_frame(*scale_frame(screen, (window_width, window_height)))
+
+
+def load_game_images():
+    # game images are decoded in background while menu is shown
+    if "player" in images:
+        return
+    pending = [path for path in game_image_paths if not asset_loader.ready(path)]
+    if pending:
+        screen.fill((20,) * 3)
+        text = get_font(30).render("Loading...", True, (200,) * 3)
+        screen.blit(text, text.get_rect(center=(width // 2, height // 2)))
+        screen_draw()
+        asset_loader.request_all(pending)
+        while wait([asset_loader.futures[path] for path in pending], timeout=0.05).not_done:
+            for event in pygame.event.get():
+                if event.type == pygame.QUIT:
+                    terminate()
+
+    game_images = {
+        "shadow": load_image("shadow.png"),
+        "player": scale(load_image("player.png"), player_size),
+        "coin": scale(load_image("coin.png"), (25,) * 2),
+        "spike_down": load_image("spike.png"),
+        "cave_ground": scale(load_image("cave_ground.png"), (28, 28)),
+        "bullet": load_image("bullet.png"),
+    }
+    for i in range(test_spikes_i):
+        game_images[f"spike_anim_{i}"] = scale(load_image(f"spikes/spike_{i}.png"), tile_s)
+    game_images["spike_up"] = rotate(game_images["spike_down"], 180)
+    game_images["spike_right"] = rotate(game_images["spike_down"], 90)
+    game_images["spike_left"] = rotate(game_images["spike_down"], -90)
+    cannon_image = scale(load_image("cannon.png"), cannon_size)
+    for angle in cannon_angles:
+        game_images[f"cannon_{angle}"] = rotate(cannon_image, angle)
+
+    # all game images and their transformed variants are packed into atlas pages
+    images.update(atlas.build(game_images))
+    for page in atlas.pages:
+        surfaces.track(page, "atlas")
+
+
+def get_font(size):
+    # every SysFont call makes a new font, so they are kept
+    if size not in fonts:
+        fonts[size] = pygame.font.SysFont('Comic Sans MS', size)
+    return fonts[size]
+
+
+def get_button_image(code):
+    name = f"button_{code}"
+    if name not in images:
+        images[name] = surfaces.track(optimize_surface(scale(load_image(f"buttons/{name}.png"), button_size)),
+                                      "buttons")
+    return images[name]
+
 
 def convert_position(x, y):
     y = window_height - y
@@ -55,7 +198,18 @@ def convert_position(x, y):
     return (x - dx) / scale_, (y - dy) / scale_
 
 
+class KeyState:
+    # replaces pygame.key.get_pressed() for recorded keys
+    def __init__(self, state):
+        self.state = state
+
+    def __getitem__(self, key):
+        return bool(self.state & input_key_bits.get(key, 0))
+
+
 def terminate():
+    if presenter is not None:
+        presenter.stop()
     pygame.quit()
     exit()
 
@@ -67,6 +221,12 @@ class Group:
     def __iter__(self):
         return self.sprites.__iter__()
 
+    def __len__(self):
+        return len(self.sprites)
+
+    def __contains__(self, sprite):
+        return sprite in self.sprites
+
     def clear(self):
         self.sprites = []
 
@@ -85,12 +245,24 @@ class Group:
             sprite.update()
 
     def draw(self):
+        draw_snapshot(self.snapshot(), screen)
+
+    def snapshot(self):
+        decorations = governor.decorations()
+        sprites = []
+        lightmaps = []
         for sprite in self:
-            rect = sprite.rect.copy()
-            rect.x -= camera_x
-            rect.y -= camera_y
-            rect.y = height - rect.y - sprite.static_height
-            screen.blit(sprite.image, rect)
+            if sprite.decorative and not decorations:
+                continue
+            if sprite.baked:
+                # baked sprites are drawn all at once by the lightmap, in place of the first one
+                lightmap = sprite.scene.lightmap
+                if lightmap not in lightmaps:
+                    lightmaps.append(lightmap)
+                    sprites += lightmap.snapshot(camera_x, camera_y)
+                continue
+            sprites.append((sprite.image, sprite.rect.copy(), sprite.static_height, 0))
+        return RenderSnapshot(camera_x, camera_y, tuple(sprites))
 
     def collide(self, rect):
         collide_func = rect.colliderect
@@ -100,15 +272,226 @@ class Group:
         return False
 
 
+class LayeredGroup(Group):
+    # sprites are kept in lists by their layer and iterated layer by layer,
+    # so a sprite is put into the middle of the draw order without sorting
+    def __init__(self, layers):
+        self.layers = {layer: [] for layer in layers}
+
+    def __iter__(self):
+        return chain.from_iterable(self.layers.values())
+
+    def __len__(self):
+        return sum(map(len, self.layers.values()))
+
+    def __contains__(self, sprite):
+        return sprite in self.layers[sprite.layer]
+
+    def clear(self):
+        self.layers = {layer: [] for layer in self.layers}
+
+    def add(self, sprite):
+        self.layers[sprite.layer].append(sprite)
+
+    def remove(self, sprite):
+        self.layers[sprite.layer].remove(sprite)
+
+    def set_layer(self, sprites, layer):
+        # new sprites are at the end of their layer, so they are found at once
+        for sprite in reversed(sprites):
+            sprites_ = self.layers[sprite.layer]
+            if sprites_ and sprites_[-1] is sprite:
+                sprites_.pop()
+            else:
+                sprites_.remove(sprite)
+        for sprite in sprites:
+            sprite.layer = layer
+            self.layers[layer].append(sprite)
+
+
+# --------------------------------------------- #
+# presentation
+
+class RenderSnapshot:
+    # everything needed to draw one frame, not changed after creation
+    __slots__ = ("camera_x", "camera_y", "sprites", "inputs")
+
+    def __init__(self, camera_x_, camera_y_, sprites, inputs=()):
+        self.camera_x = camera_x_
+        self.camera_y = camera_y_
+        self.sprites = sprites
+        # times of key presses first shown by this frame
+        self.inputs = inputs
+
+
+def draw_snapshot(snapshot, surface):
+    camera_x_, camera_y_ = snapshot.camera_x, snapshot.camera_y
+    for image, rect, static_height, special_flags in snapshot.sprites:
+        surface.blit(image, (rect.x - camera_x_, height - (rect.y - camera_y_) - static_height),
+                     special_flags=special_flags)
+
+
+class QualityGovernor:
+    # lowers quality step by step while frames are over budget and raises it back when they are fast again
+    def __init__(self, budget, smooth_scaling=False, max_frame_skip=2,
+                 degrade_after=10, recover_after=120, headroom=0.7):
+        self.steps = []
+        if smooth_scaling:
+            self.steps.append("fast_scaling")
+        self.steps.append("no_decorations")
+        self.steps += ["frame_skip"] * max_frame_skip
+
+        self.budget = budget
+        self.degrade_after = degrade_after
+        self.recover_after = recover_after
+        self.headroom = headroom
+
+        self.level = 0
+        self.frame_time = 0
+        self.slow_frames = 0
+        self.fast_frames = 0
+        self.recover_wait = recover_after
+        self.frames_since_recover = None
+        self.presented = 0
+
+    def update(self, frame_time):
+        self.frame_time = self.frame_time * 0.9 + frame_time * 0.1
+        if self.frames_since_recover is not None:
+            self.frames_since_recover += 1
+
+        if self.frame_time > self.budget:
+            self.slow_frames += 1
+            self.fast_frames = 0
+        elif self.frame_time < self.budget * self.headroom:
+            self.fast_frames += 1
+            self.slow_frames = 0
+        else:
+            self.slow_frames = self.fast_frames = 0
+
+        if self.slow_frames >= self.degrade_after and self.level < len(self.steps):
+            # recovering was too early, next time wait longer
+            if self.frames_since_recover is not None and self.frames_since_recover < self.recover_wait:
+                self.recover_wait = min(self.recover_wait * 2, self.recover_after * 16)
+            self.set_level(self.level + 1)
+        elif self.fast_frames >= self.recover_wait and self.level > 0:
+            self.set_level(self.level - 1)
+            self.frames_since_recover = 0
+
+    def set_level(self, level):
+        self.level = level
+        self.slow_frames = self.fast_frames = 0
+
+    def active(self, step):
+        return step in self.steps[:self.level]
+
+    def smooth_scaling(self):
+        return "fast_scaling" in self.steps and not self.active("fast_scaling")
+
+    def decorations(self):
+        return not self.active("no_decorations")
+
+    def frame_skip(self):
+        return self.steps[:self.level].count("frame_skip")
+
+    def present(self):
+        # called for every rendered frame, false if the frame has to be skipped
+        self.presented = (self.presented + 1) % (self.frame_skip() + 1)
+        return self.presented == 0
+
+    def state(self):
+        return {
+            "level": self.level,
+            "frame_time_ms": round(self.frame_time * 1000, 2),
+            "smooth_scaling": self.smooth_scaling(),
+            "decorations": self.decorations(),
+            "frame_skip": self.frame_skip(),
+        }
+
+
+class Presenter:
+    # draws and scales frames in own thread while next frame is simulated,
+    # the main thread shows them, because the window must not be used by other threads
+    def __init__(self):
+        self.condition = threading.Condition()
+        self.snapshot = None
+        self.window_size = None
+        self.frame = None
+        self.canvas = surfaces.track(pygame.Surface((width, height)), "Presenter")
+        self.running = True
+        self.presented = 0
+        self.dropped = 0
+        # time of drawing and scaling the last frame, it is not a part of the main thread time
+        self.frame_time = 0
+        self.thread = threading.Thread(target=self.run, name="presenter", daemon=True)
+        self.thread.start()
+
+    def submit(self, snapshot):
+        # only the latest snapshot is kept, simulation never waits for presentation
+        with self.condition:
+            if self.snapshot is not None:
+                self.dropped += 1
+                snapshot.inputs = self.snapshot.inputs + snapshot.inputs
+            self.snapshot = snapshot
+            # window size is changed by the main thread, so it is passed with the snapshot
+            self.window_size = (window_width, window_height)
+            self.condition.notify()
+
+    def run(self):
+        while True:
+            with self.condition:
+                while self.snapshot is None and self.running:
+                    self.condition.wait()
+                if not self.running:
+                    return
+                snapshot = self.snapshot
+                window_size = self.window_size
+                self.snapshot = None
+            start = perf_counter()
+            self.canvas.fill((20,) * 3)
+            draw_snapshot(snapshot, self.canvas)
+            image, pos = scale_frame(self.canvas, window_size)
+            self.frame_time = perf_counter() - start
+            with self.condition:
+                inputs = snapshot.inputs
+                if self.frame is not None:
+                    self.dropped += 1
+                    inputs = self.frame[2] + inputs
+                self.frame = (image, pos, inputs)
+
+    def flip(self):
+        # called by the main thread, shows the latest finished frame
+        with self.condition:
+            frame = self.frame
+            self.frame = None
+        if frame is None:
+            return
+        image, pos, inputs = frame
+        present_frame(image, pos)
+        pacer.presented(inputs)
+        self.presented += 1
+
+    def stop(self):
+        with self.condition:
+            self.running = False
+            self.condition.notify()
+        if self.thread is not threading.current_thread():
+            self.thread.join()
+
+
 # --------------------------------------------- #
 # main sprites classes
 
 class ImageSprite(pygame.sprite.Sprite):
+    decorative = False
+    baked = False
+    # draw layer in GameScene, level sprites get the layer of their type
+    layer = "others"
+
     def __init__(self, scene, pos, image):
         super().__init__()
         scene.group_all.add(self)
         self.scene = scene
-        self.image = image
+        self.image = surfaces.track(image, type(self).__name__)
         self.rect = image.get_rect()
         self.static_height = self.rect.height
         self.set_pos(*pos)
@@ -147,54 +530,50 @@ class MovableSprite(ImageSprite):
         self.rect.y = y
 
 
-class SimpleAnimSprite(ImageSprite):
-    def __init__(self, scene, pos, images, rects=None):
-        super().__init__(scene, pos, images[0])
-        self.anims_rects = None
+class AnimationClip:
+    # frames shared by all sprites of one kind, frame of every tick is precomputed
+    def __init__(self, images, rects=None, frame_time=0.5, mode="pingpong", hold_time=2):
+        self.images = images
         if isinstance(rects, tuple):
-            self.anims_rects = None
-            self.set_rect(rects)
-        elif isinstance(rects, list):
-            self.anims_rects = rects
-            self.set_rect(rects[0])
+            rects = [rects] * len(images)
+        self.rects = rects
+
+        frame_ticks = round(frame_time / dt)
+        hold_ticks = round(hold_time / dt)
+        last = len(images) - 1
+        if mode == "loop":
+            durations = [(i, frame_ticks) for i in range(len(images))]
+        else:
+            # forward, the last frame again after a hold, backward, then a hold on the first frame
+            durations = [(i, frame_ticks) for i in range(last)]
+            durations.append((last, frame_ticks * 2 + hold_ticks))
+            durations += [(i, frame_ticks) for i in range(last - 1, 0, -1)]
+            durations.append((0, hold_ticks))
+        self.schedule = array('B')
+        for i, ticks in durations:
+            self.schedule.extend([i] * ticks)
+
+    def frame(self, tick):
+        return self.schedule[tick % len(self.schedule)]
 
-        self.anims = images
-        self.anim_wait = 0.5
-        self.reverse_wait = 2
 
+class SimpleAnimSprite(ImageSprite):
+    def __init__(self, scene, pos, clip):
+        super().__init__(scene, pos, clip.images[0])
+        self.clip = clip
+        # animation starts when the sprite is made
+        self.phase = scene.ticks
         self.anim_i = 0
-        self.anim_wait_i = 0
-        self.reverse = 1
-        self.reverse_wait_i = 0
+        if clip.rects is not None:
+            self.set_rect(clip.rects[0])
 
     def update(self):
-        if self.reverse_wait_i > 0:
-            self.reverse_wait_i -= dt
-            return
-        if self.reverse_wait_i <= 0:
-            self.anim_wait_i += dt
-            if self.anim_wait_i >= self.anim_wait:
-                self.anim_wait_i -= self.anim_wait
-                self.next_anim()
-
-    def next_anim(self):
-        if self.reverse == 0:
-            self.anim_i += 1
-            self.anim_i %= len(self.anims)
-        elif self.reverse == 1:
-            self.anim_i += 1
-            if self.anim_i == len(self.anims):
-                self.reverse_wait_i = self.reverse_wait
-                self.anim_i -= 1
-                self.reverse = 2
-        else:
-            self.anim_i -= 1
-            if self.anim_i == 0:
-                self.reverse_wait_i = self.reverse_wait
-                self.reverse = 1
-        self.image = self.anims[self.anim_i]
-        if self.anims_rects is not None:
-            self.set_rect(self.anims_rects[self.anim_i])
+        anim_i = self.clip.frame(self.scene.ticks - self.phase)
+        if anim_i != self.anim_i:
+            self.anim_i = anim_i
+            self.image = self.clip.images[anim_i]
+            if self.clip.rects is not None:
+                self.set_rect(self.clip.rects[anim_i])
 
 
 class TriggerSprite(ImageSprite):
@@ -207,6 +586,8 @@ class TriggerSprite(ImageSprite):
 
 
 class ParticleSprite(MovableSprite):
+    decorative = True
+
     def __init__(self, scene, pos, color=(255, 0, 0)):
         image = pygame.Surface((5,) * 2)
         image.fill(color)
@@ -223,9 +604,40 @@ class ParticleSprite(MovableSprite):
         self.move()
 
 
+class FadeEffect:
+    tables = {}
+
+    def __init__(self, image, duration, frames=16):
+        self.frames = self.get_frames(image, frames)
+        self.duration = duration
+        self.time = 0
+
+    @classmethod
+    def get_frames(cls, image, frames):
+        # frames of the image with alpha going from 255 to 0, shared between all instances
+        key = (id(image), frames)
+        if key not in cls.tables:
+            table = []
+            for i in range(frames):
+                frame = surfaces.track(alpha_copy(image), "fade")
+                alpha = 255 * (frames - i) // frames
+                frame.fill((255, 255, 255, alpha), special_flags=pygame.BLEND_RGBA_MULT)
+                table.append(frame)
+            cls.tables[key] = (image, table)
+        return cls.tables[key][1]
+
+    def update(self):
+        self.time += dt
+        return self.time < self.duration
+
+    def get_image(self):
+        i = int(self.time / self.duration * len(self.frames))
+        return self.frames[min(i, len(self.frames) - 1)]
+
+
 class TextSprite(ImageSprite):
     def __init__(self, scene, pos, font, text):
-        image = pygame.font.SysFont('Comic Sans MS', font).render(text, True, (0, 0, 0))
+        image = get_font(font).render(text, True, (0, 0, 0))
         super().__init__(scene, pos, image)
 
 
@@ -234,7 +646,7 @@ class TextSprite(ImageSprite):
 
 class SpawnSprite(TriggerSprite):
     def __init__(self, scene, pos, size, spawn_pos, priority):
-        super().__init__(scene, pos, scale(void_image, size))
+        super().__init__(scene, pos, optimize_surface(scale(void_image, size)))
         self.spawn_pos = spawn_pos
         self.priority = priority
 
@@ -250,16 +662,18 @@ class ButtonSprite(ImageSprite):
 
 
 def create_button(scene, pos, code):
-    ButtonSprite(scene, pos, scale(load_image(f"buttons/button_{code}.png"), button_size), code)
+    ButtonSprite(scene, pos, get_button_image(code), code)
 
 
 class PlayerSprite(MovableSprite):
+    layer = "players"
+
     def __init__(self, scene, pos):
-        super().__init__(scene, pos, scale(load_image("player.png"), player_size))
+        super().__init__(scene, pos, images["player"])
         self.spawn_priority = 0
         self.spawn_position = pos
-        self.keys = {}
-        self.collisions = {}
+        self.keys = KeyState(0)
+        self.collisions = 0
 
         self.jump_can = True
         self.jump_pressed_w = 0
@@ -274,22 +688,14 @@ class PlayerSprite(MovableSprite):
         self.can_dash = True
         self.dash_w = 0
 
-    def collision_all(self, *collides):
-        for collide in collides:
-            if not self.collisions[collide]:
-                return False
-        return True
-
-    def collision_any(self, *collides):
-        for collide in collides:
-            if self.collisions[collide]:
-                return True
-        return False
-
     # input functions
     def set_spawn(self, pos, priority):
-        if self.spawn_priority < priority:
+        if self.spawn_priority < priority and self.spawn_position != pos:
             self.spawn_position = pos
+            self.spawned()
+
+    def spawned(self):
+        self.scene.checkpoint = WorldSnapshot(self.scene)
 
     def dash(self):
         if DEBUG:
@@ -334,9 +740,9 @@ class PlayerSprite(MovableSprite):
                 self.vy = jump_force
                 return True
         # wall jump
-        elif self.collision_any(COLLIDE_RIGHT, COLLIDE_LEFT):
+        elif self.collisions & COLLIDE_SIDES:
             # jump up
-            xd = 1 if self.collisions[COLLIDE_LEFT] else -1
+            xd = 1 if self.collisions & COLLIDE_LEFT else -1
             self.vx = wall_jump_x * xd
             self.vy = wall_jump_y
             self.hooked = False
@@ -354,6 +760,10 @@ class PlayerSprite(MovableSprite):
         camera_y = self.y - (height - player_size[1]) // 2
         self.vx, self.vy = 0, 0
         self.jump_mercy = 0
+        self.scene.checkpoint_restore = True
+        if self.scene.recorder is not None:
+            # bullets of a ghost run are not the same, so its deaths are taken from the recording
+            self.scene.recorder.record_death()
 
     # update functions
     def update(self):
@@ -363,18 +773,22 @@ class PlayerSprite(MovableSprite):
 
         self.check_collides()
         self.check_triggers()
-        self.keys = pygame.key.get_pressed()
-
-        # waiting
-        self.jump_ground_w = approach(self.jump_ground_w, 0, dt)
-        self.jump_pressed_w = approach(self.jump_pressed_w, 0, dt)
-        if self.dash_w > 0:
-            self.dash_w = approach(self.dash_w, 0, dt)
+        self.keys = self.read_keys()
+
+        # waiting, timers are never negative, so approach to 0 is inlined
+        w = self.jump_ground_w
+        self.jump_ground_w = 0 if w <= dt else w - dt
+        w = self.jump_pressed_w
+        self.jump_pressed_w = 0 if w <= dt else w - dt
+        w = self.dash_w
+        if w > 0:
+            self.dash_w = 0 if w <= dt else w - dt
             if not self.dash_w > 0:
                 self.vy = dash_end_y_force * sign(self.vy)
-        self.hook_not_w = approach(self.hook_not_w, 0, dt)
+        w = self.hook_not_w
+        self.hook_not_w = 0 if w <= dt else w - dt
 
-        if self.collisions[COLLIDE_DOWN]:
+        if self.collisions & COLLIDE_DOWN:
             self.jump_can = True
             if self.dash_w == 0:
                 self.can_dash = True
@@ -397,20 +811,26 @@ class PlayerSprite(MovableSprite):
             if self.jump():
                 self.jump_mercy = 0
             else:
-                self.jump_mercy = approach(self.jump_mercy, 0, dt)
+                w = self.jump_mercy
+                self.jump_mercy = 0 if w <= dt else w - dt
 
         self.check_stops()
         self.move()
 
-        # collect coins
-        for coin in self.scene.group_coins:
-            if self.rect.colliderect(coin.rect):
-                coin.collected()
+        self.collect_coins()
 
         # spikes
         if self.scene.group_spikes.collide(self.rect):
             self.die()
 
+    def read_keys(self):
+        return self.scene.keys
+
+    def collect_coins(self):
+        for coin in self.scene.group_coins:
+            if self.rect.colliderect(coin.rect):
+                coin.collected()
+
     def check_triggers(self):
         collide_func = self.rect.colliderect
         for trigger in self.scene.group_triggers:
@@ -419,7 +839,7 @@ class PlayerSprite(MovableSprite):
 
     def debug_move(self):
         self.check_triggers()
-        keys = pygame.key.get_pressed()
+        keys = self.read_keys()
         f = 2
         if keys[KEY_JUMP]:
             f *= 3
@@ -434,52 +854,53 @@ class PlayerSprite(MovableSprite):
         self.move()
 
     def check_collides(self):
-        collisions = {
-            COLLIDE_UP: False,
-            COLLIDE_DOWN: False,
-            COLLIDE_LEFT: False,
-            COLLIDE_RIGHT: False,
-            COLLIDE_HOOK_UP: False,
-            COLLIDE_HOOK_DOWN: False,
-        }
-        r1 = self.rect
-        for sprite in self.scene.group_walls:
-            r2 = sprite.rect
-
-            x11, y11 = r1.topleft
-            w1, h1 = r1.size
-            x12, y12 = x11 + w1, y11 + h1
-
-            x21, y21 = r2.topleft
-            w2, h2 = r2.size
-            x22, y22 = x21 + w2, y21 + h2
-
-            collide_x = x11 <= x22 and x12 >= x21
-            collide_y = y11 <= y22 and y12 >= y21
-            if not (collide_x and collide_y):
+        # all walls are checked against the rect before pushes, so the player can be pushed twice
+        collisions = 0
+        rect = self.rect
+        x11, y11, w1, h1 = rect
+        x12 = x11 + w1
+        y12 = y11 + h1
+        hook_up_y = y11 + h1 * 2 / 3
+        hook_down_y = y11 + h1 / 3
+        # merged walls only find the level rects near the player, and the pushes are made by these rects
+        # in level order, so collisions do not depend on how the walls were merged
+        touched_sources = ()
+        touched = None
+        for x21, y21, x22, y22, sources in self.scene.wall_bounds:
+            if x11 > x22 or x12 < x21 or y11 > y22 or y12 < y21:
+                continue
+            if not touched_sources:
+                touched_sources = sources
+                continue
+            # level rects of several merged walls are joined only then, one wall has them in order already
+            if touched is None:
+                touched = {source[0]: source for source in touched_sources}
+            for source in sources:
+                touched[source[0]] = source
+        if touched is not None:
+            touched_sources = sorted(touched.values())
+        for _, x21, y21, x22, y22, center_x, center_y in touched_sources:
+            if x11 > x22 or x12 < x21 or y11 > y22 or y12 < y21:
                 continue
 
-            some_collide_x = min(abs(x12 - x21), abs(x11 - x22)) < max_collide_pixels
-            some_collide_y = min(abs(y12 - y21), abs(y11 - y22)) < max_collide_pixels
-
-            if collide_y and not some_collide_x:
-                if y11 >= y21 + h2 / 2:
-                    collisions[COLLIDE_DOWN] = True
+            if not (abs(x12 - x21) < max_collide_pixels or abs(x11 - x22) < max_collide_pixels):
+                if y11 >= center_y:
+                    collisions |= COLLIDE_DOWN
                     self.y += y22 - y11
                 else:
-                    collisions[COLLIDE_UP] = True
+                    collisions |= COLLIDE_UP
                     self.y += y21 - y12
-            if collide_x and not some_collide_y:
-                if x11 >= x21 + w2 / 2:
-                    collisions[COLLIDE_LEFT] = True
+            if not (abs(y12 - y21) < max_collide_pixels or abs(y11 - y22) < max_collide_pixels):
+                if x11 >= center_x:
+                    collisions |= COLLIDE_LEFT
                     self.x += x22 - x11
                 else:
-                    collisions[COLLIDE_RIGHT] = True
+                    collisions |= COLLIDE_RIGHT
                     self.x += x21 - x12
-            if not y11 + h1 * 2 / 3 > y22:
-                collisions[COLLIDE_HOOK_UP] = True
-            if not y11 + h1 / 3 < y21:
-                collisions[COLLIDE_HOOK_DOWN] = True
+            if not hook_up_y > y22:
+                collisions |= COLLIDE_HOOK_UP
+            if not hook_down_y < y21:
+                collisions |= COLLIDE_HOOK_DOWN
         self.collisions = collisions
 
     def check_hook(self):
@@ -488,12 +909,12 @@ class PlayerSprite(MovableSprite):
         # check if you out of available space
         if self.hooked:
             if self.hook_right:
-                if not self.collisions[COLLIDE_RIGHT]:
+                if not self.collisions & COLLIDE_RIGHT:
                     self.hooked = False
             else:
-                if not self.collisions[COLLIDE_LEFT]:
+                if not self.collisions & COLLIDE_LEFT:
                     self.hooked = False
-            if not self.collision_all(COLLIDE_HOOK_DOWN, COLLIDE_HOOK_UP):
+            if self.collisions & COLLIDE_HOOK != COLLIDE_HOOK:
                 self.hooked = False
                 if not self.vy < 0:
                     self.vy = 260
@@ -504,11 +925,11 @@ class PlayerSprite(MovableSprite):
                 self.hooked = False
             else:
                 # if you try to hook
-                if self.hook_not_w == 0 and self.collision_any(COLLIDE_LEFT, COLLIDE_RIGHT) and \
-                        self.collision_all(COLLIDE_HOOK_DOWN, COLLIDE_HOOK_UP):
+                if self.hook_not_w == 0 and self.collisions & COLLIDE_SIDES and \
+                        self.collisions & COLLIDE_HOOK == COLLIDE_HOOK:
                     self.hooked = True
                     self.vy = 0
-                    self.hook_right = self.collisions[COLLIDE_RIGHT]
+                    self.hook_right = self.collisions & COLLIDE_RIGHT != 0
 
         # y move
         if self.hooked and self.hook_not_w == 0:
@@ -521,7 +942,7 @@ class PlayerSprite(MovableSprite):
 
     def move_y(self):
         if not ((self.hooked and self.hook_not_w == 0) or self.dash_w != 0):
-            if not self.collisions[COLLIDE_DOWN]:
+            if not self.collisions & COLLIDE_DOWN:
                 self.vy -= gravity * dt
                 if self.vy < -max_gravity:
                     self.vy = -max_gravity
@@ -531,7 +952,7 @@ class PlayerSprite(MovableSprite):
         if self.hooked or self.dash_w > 0:
             return
 
-        mult = 1 if self.collisions[COLLIDE_DOWN] else friction_air
+        mult = 1 if self.collisions & COLLIDE_DOWN else friction_air
 
         key_x = 0
         if self.keys[KEY_RIGHT]:
@@ -547,41 +968,107 @@ class PlayerSprite(MovableSprite):
             self.vx = approach(self.vx, max_move * key_x, friction_accel * mult * dt)
 
     def check_stops(self):
-        if self.collisions[COLLIDE_UP]:
+        collisions = self.collisions
+        if collisions & COLLIDE_UP:
             if self.vy > 0:
                 self.vy = 0
-        if self.collisions[COLLIDE_DOWN]:
+        if collisions & COLLIDE_DOWN:
             if self.vy < 0:
                 self.vy = 0
-        if self.collisions[COLLIDE_RIGHT]:
+        if collisions & COLLIDE_RIGHT:
             if self.vx > 0:
                 self.vx = 0
-        if self.collisions[COLLIDE_LEFT]:
+        if collisions & COLLIDE_LEFT:
             if self.vx < 0:
                 self.vx = 0
 
 
+class GhostSprite(PlayerSprite):
+    # replays recorded input of a level, does not affect the world and is not hit by its bullets
+    def __init__(self, scene, pos, reader):
+        super().__init__(scene, pos)
+        self.reader = reader
+        self.image = alpha_copy(self.image)
+        self.image.fill((255, 255, 255, 100), special_flags=pygame.BLEND_RGBA_MULT)
+        self.ghost_keys = KeyState(0)
+
+    def update(self):
+        state = self.reader.read()
+        if state is None:
+            self.reader.close()
+            self.scene.group_all.remove(self)
+            return
+        self.ghost_keys = KeyState(state)
+        if state & EVENT_JUMP:
+            self.jump_mercy = jump_mercy
+        if state & EVENT_DASH:
+            self.dash()
+        super().update()
+        if self.reader.read_death():
+            self.die()
+
+    def read_keys(self):
+        return self.ghost_keys
+
+    def collect_coins(self):
+        pass
+
+    def check_triggers(self):
+        collide_func = self.rect.colliderect
+        for trigger in self.scene.group_triggers:
+            if isinstance(trigger, SpawnSprite) and collide_func(trigger.rect):
+                self.set_spawn(trigger.spawn_pos, trigger.priority)
+
+    def spawned(self):
+        pass
+
+    def die(self):
+        self.set_pos(*self.spawn_position)
+        self.vx, self.vy = 0, 0
+        self.jump_mercy = 0
+
+
 class CoinSprite(ImageSprite):
     def __init__(self, scene, pos):
-        super().__init__(scene, pos, coin_image)
+        super().__init__(scene, pos, images["coin"])
         self.position = pos
         self.scene.group_coins.add(self)
+        self.scene.coins.add(self)
         self.player_connect = False
-        self.timer = -1
+        self.fade = None
 
     def update(self):
-        if self.timer != -1:
-            self.timer -= 1
-            self.image.set_alpha(self.timer)
-            if self.timer == 0:
+        if self.fade is not None:
+            if self.fade.update():
+                self.image = self.fade.get_image()
+            else:
                 self.scene.group_all.remove(self)
 
     def collected(self):
         global coins_count
         coins_count += 1
-        self.timer = 255
+        self.fade = FadeEffect(images["coin"], coin_fade_time)
+        self.image = self.fade.get_image()
         self.scene.group_coins.remove(self)
 
+    def is_collected(self):
+        return self not in self.scene.group_coins
+
+    def set_collected(self, collected):
+        # used by snapshots, no fade
+        self.fade = None
+        self.image = images["coin"]
+        if collected:
+            if self in self.scene.group_coins:
+                self.scene.group_coins.remove(self)
+            if self in self.scene.group_all:
+                self.scene.group_all.remove(self)
+        else:
+            if self not in self.scene.group_coins:
+                self.scene.group_coins.add(self)
+            if self not in self.scene.group_all:
+                self.scene.group_all.add(self)
+
 
 class SpikeSprite(ImageSprite):
     def __init__(self, scene, pos, typ, length):
@@ -592,13 +1079,13 @@ class SpikeSprite(ImageSprite):
 
     def _choice_image(self, typ):
         if typ == "l":
-            return spike_image_left
+            return images["spike_left"]
         elif typ == "r":
-            return spike_image_right
+            return images["spike_right"]
         elif typ == "u":
-            return spike_image_up
+            return images["spike_up"]
         else:
-            return spike_image_down
+            return images["spike_down"]
 
     def _create_image(self, spike_image, length, typ):
         k = 1 if typ in "lr" else 0
@@ -612,21 +1099,43 @@ class SpikeSprite(ImageSprite):
         for i in range(length):
             image.blit(spike_image, pos_)
             pos_[k] += spike_size
-        return image
+        return optimize_surface(image)
 
 
 class TestSpikeSprite(SimpleAnimSprite):
+    clip = None
+
     def __init__(self, scene, pos):
-        super().__init__(scene, pos, test_spike_anims, test_spike_sizes)
+        if TestSpikeSprite.clip is None:
+            anims = [images[f"spike_anim_{i}"] for i in range(test_spikes_i)]
+            TestSpikeSprite.clip = AnimationClip(anims, test_spike_sizes)
+        super().__init__(scene, pos, self.clip)
         scene.group_spikes.add(self)
 
 
 class SimpleWallSprite(ImageSprite):
-    def __init__(self, scene, pos, size):
+    def __init__(self, scene, pos, size, collide=True):
         super().__init__(scene, pos, scale(black_image, size))
+        if collide:
+            scene.group_walls.add(self)
+
+
+class ColliderRect:
+    # invisible wall, used for merged collision rects
+    def __init__(self, scene, pos, size):
+        self.rect = pygame.Rect(pos, size)
+        # bounds of the level rects it touches, the player is pushed by them
+        self.sources = []
         scene.group_walls.add(self)
 
 
+def optimize_rects(rects):
+    merged = merge_rects(rects)
+    if len(merged) < len(rects):
+        return merged
+    return rects
+
+
 class WallSprite(ImageSprite):
     def __init__(self, scene, pos, typ, length):
         wall_image = self._choice_image(typ)
@@ -636,7 +1145,7 @@ class WallSprite(ImageSprite):
 
     def _choice_image(self, typ):
         if typ == "ground":
-            return wall_cave_ground
+            return images["cave_ground"]
         else:
             pass
 
@@ -648,56 +1157,184 @@ class WallSprite(ImageSprite):
         for i in range(length // wall_size + 1):
             image.blit(wall_image, pos_)
             pos_[0] += wall_size
-        return image
+        return optimize_surface(image)
 
 
 class ShadowSprite(ImageSprite):
+    decorative = True
+    baked = True
+
     def __init__(self, scene, pos, size, angle=0):
-        image = rotate(scale(shadow, size), angle)
-        super().__init__(scene, pos, image)
+        # full image is made only for the rect, the reduced one is baked into the lightmap
+        rect_size = rotate(scale(images["shadow"], size), angle).get_size()
+        reduced_size = [max(1, round(x / lightmap_scale)) for x in size]
+        super().__init__(scene, pos, rotate(scale(images["shadow"], reduced_size), angle))
+        self.set_rect(rect_size)
+        self.static_height = self.rect.height
+        scene.lightmap.add(self)
+
+
+class Lightmap:
+    # baked sprites are black with alpha, so drawing them is the same as multiplying the scene by
+    # the light left after them, it is baked into tiles at reduced resolution and scaled back
+    def __init__(self):
+        self.tile_sprites = {}
+        self.tiles = {}
+        self.dirty = set()
+
+    def get_tiles(self, rect):
+        return [(x, y) for x in range(rect.left // lightmap_tile, (rect.right - 1) // lightmap_tile + 1)
+                for y in range(rect.top // lightmap_tile, (rect.bottom - 1) // lightmap_tile + 1)]
+
+    def get_sprite_tiles(self, sprite):
+        # tiles bake a border reaching into their neighbours, so a sprite next to a tile is in it too
+        return self.get_tiles(sprite.rect.inflate(2 * lightmap_scale, 2 * lightmap_scale))
+
+    def clear(self):
+        self.tile_sprites = {}
+        self.tiles = {}
+        self.dirty = set()
+
+    def add(self, sprite):
+        for tile in self.get_sprite_tiles(sprite):
+            self.tile_sprites.setdefault(tile, []).append(sprite)
+            self.dirty.add(tile)
+
+    def remove(self, sprite):
+        for tile in self.get_sprite_tiles(sprite):
+            self.tile_sprites[tile].remove(sprite)
+            self.dirty.add(tile)
+
+    def __contains__(self, sprite):
+        return any(sprite in self.tile_sprites.get(tile, ()) for tile in self.get_sprite_tiles(sprite))
+
+    def bake(self):
+        # only tiles with changed sprites are made again
+        for tile in self.dirty:
+            if self.tile_sprites.get(tile):
+                self.tiles[tile] = surfaces.track(self.bake_tile(tile), "Lightmap")
+            else:
+                self.tiles.pop(tile, None)
+                self.tile_sprites.pop(tile, None)
+        self.dirty = set()
+
+    def bake_tile(self, tile):
+        # one texel border is baked too, so smooth scaling has no seams between tiles
+        size = lightmap_tile // lightmap_scale + 2
+        light = pygame.Surface((size, size))
+        light.fill((255,) * 3)
+        left = tile[0] * lightmap_tile - lightmap_scale
+        top = (tile[1] + 1) * lightmap_tile + lightmap_scale
+        for sprite in self.tile_sprites[tile]:
+            rect = sprite.rect
+            light.blit(sprite.image, (round((rect.x - left) / lightmap_scale),
+                                      round((top - rect.y - rect.h) / lightmap_scale)))
+        full = smoothscale(light, (size * lightmap_scale,) * 2)
+        return full.subsurface((lightmap_scale, lightmap_scale, lightmap_tile, lightmap_tile)).copy()
+
+    def snapshot(self, camera_x_, camera_y_):
+        # visible tiles, drawn like sprites with multiply blend
+        if self.dirty:
+            self.bake()
+        view = pygame.Rect(camera_x_, camera_y_, width, height)
+        sprites = []
+        for tile in self.get_tiles(view):
+            image = self.tiles.get(tile)
+            if image is not None:
+                rect = pygame.Rect(tile[0] * lightmap_tile, tile[1] * lightmap_tile, lightmap_tile, lightmap_tile)
+                sprites.append((image, rect, lightmap_tile, pygame.BLEND_MULT))
+        return sprites
 
 
 class DoorSprite(TriggerSprite):
     def __init__(self, scene, pos, level):
-        super().__init__(scene, pos, scale(yellow_image, (40, 60)))
+        super().__init__(scene, pos, optimize_surface(scale(yellow_image, (40, 60))))
         self.level = level
 
     def triggered(self):
         self.scene.load_level(self.level)
 
 
-class CannonSprite(ImageSprite):
-    def __init__(self, scene, pos, size, angle, data):
-        super().__init__(scene, pos, rotate(scale(cannon_image, size), angle))
+class CannonBattery(ImageSprite):
+    # a grid of cannons as one sprite, every barrel has its own rate, speed and phase
+    def __init__(self, scene, pos, size, angle, data, xy=(1, 1)):
+        image = get_cannon_image(size, angle)
+        super().__init__(scene, pos, get_battery_image(image, size, angle, xy))
+        scene.group_cannons.add(self)
         self.angle = angle
-        pos[0] += self.rect.w / 2 - 3
-        pos[1] += self.rect.h / 2 - 3
-        self.pos = pos
         rate, speed, rnd, rnd0 = data
-        rate = randint(rate // rnd, rate * rnd // 1)
-        speed = randint(speed // rnd, speed * rnd // 1)
-        self.rate = rate
-        self.speed = speed
+        self.rates = array('l')
+        self.speeds = array('l')
+        self.positions = array('d')
+        # tick of the battery when every barrel fires next
+        self.due = array('l')
+        for x in range(xy[0]):
+            for y in range(xy[1]):
+                self.positions.extend((pos[0] + size[0] * x + image.get_width() / 2 - 3,
+                                       pos[1] + size[1] * y + image.get_height() / 2 - 3))
+                barrel_rate = randint(rate // rnd, rate * rnd // 1)
+                self.rates.append(barrel_rate)
+                self.speeds.append(randint(speed // rnd, speed * rnd // 1))
+                tick = randint(0, barrel_rate) if rnd0 else 0
+                self.due.append(barrel_rate - tick)
         self.tick = 0
-        if rnd0:
-            self.tick = randint(0, rate)
+        self.next_due = min(self.due)
 
-    def update(self):
-        self.tick += 1
-        if self.tick >= self.rate:
-            BulletSprite(self.scene, self.pos, self.angle, self.speed)
-            self.tick -= self.rate
+    def get_ticks(self):
+        # ticks since the last shot of every barrel
+        return [rate - due + self.tick for rate, due in zip(self.rates, self.due)]
 
+    def set_ticks(self, ticks):
+        self.tick = 0
+        for i, tick in enumerate(ticks):
+            self.due[i] = self.rates[i] - tick
+        self.next_due = min(self.due)
 
-def create_cannon(scene, pos, size, angle, data, xy=(1, 1)):
-    for x in range(xy[0]):
-        for y in range(xy[1]):
-            CannonSprite(scene, [pos[0] + size[0] * x, pos[1] + size[1] * y], size, angle, data)
+    def update(self):
+        self.tick += 1
+        if self.tick < self.next_due:
+            return
+        tick = self.tick
+        due = self.due
+        positions = self.positions
+        for i in range(len(due)):
+            if tick >= due[i]:
+                BulletSprite(self.scene, (positions[2 * i], positions[2 * i + 1]), self.angle, self.speeds[i])
+                due[i] += self.rates[i]
+        self.next_due = min(due)
+
+
+def get_cannon_image(size, angle):
+    # usual cannons are prepared in atlas
+    name = f"cannon_{angle}"
+    if tuple(size) == cannon_size and name in images:
+        return images[name]
+    return optimize_surface(rotate(scale(images["cannon_0"], size), angle))
+
+
+def get_battery_image(image, size, angle, xy):
+    # all barrels of a battery are drawn as one image, batteries of the same shape share it
+    if tuple(xy) == (1, 1):
+        return image
+    key = (tuple(size), angle, tuple(xy))
+    if key not in battery_images:
+        w, h = image.get_size()
+        battery_h = size[1] * (xy[1] - 1) + h
+        result = pygame.Surface((size[0] * (xy[0] - 1) + w, battery_h), pygame.SRCALPHA, 32).convert_alpha()
+        result.fill((0, 0, 0, 0))
+        barrel = alpha_copy(image)
+        for x in range(xy[0]):
+            for y in range(xy[1]):
+                # world y is up, so barrels with bigger y are higher in the image
+                result.blit(barrel, (size[0] * x, battery_h - h - size[1] * y), special_flags=pygame.BLEND_RGBA_MAX)
+        battery_images[key] = optimize_surface(result)
+    return battery_images[key]
 
 
 class BulletSprite(MovableSprite):
     def __init__(self, scene, pos, angle, speed):
-        super().__init__(scene, pos, bullet_image)
+        super().__init__(scene, pos, images["bullet"])
+        scene.group_bullets.add(self)
         if angle == 0:
             self.vy = speed
         elif angle == 180:
@@ -713,6 +1350,99 @@ class BulletSprite(MovableSprite):
             self.scene.player.die()
         if self.scene.group_walls.collide(self.rect):
             self.scene.group_all.remove(self)
+            self.scene.group_bullets.remove(self)
+
+
+# --------------------------------------------- #
+# world state
+
+class WorldSnapshot:
+    player_values = ("x", "y", "vx", "vy", "jump_pressed_w", "jump_ground_w", "jump_mercy",
+                     "hook_not_w", "dash_w", "spawn_priority")
+    player_flags = ("jump_can", "hooked", "hook_right", "dash_skill", "can_dash")
+
+    def __init__(self, scene):
+        player = scene.player
+        self.values = array('d', [getattr(player, name) for name in self.player_values])
+        self.values.extend(player.spawn_position)
+        self.values.extend((camera_x, camera_y))
+        self.flags = 0
+        for i, name in enumerate(self.player_flags):
+            if getattr(player, name):
+                self.flags |= 1 << i
+
+        self.cannons = array('l')
+        for battery in scene.group_cannons:
+            self.cannons.extend(battery.get_ticks())
+        self.bullets = array('d')
+        for bullet in scene.group_bullets:
+            self.bullets.extend((bullet.x, bullet.y, bullet.vx, bullet.vy))
+        self.coins = array('b', [coin.is_collected() for coin in scene.coins])
+        self.coins_count = coins_count
+
+    def nbytes(self):
+        arrays = (self.values, self.cannons, self.bullets, self.coins)
+        return sum(len(a) * a.itemsize for a in arrays) + snapshot_overhead
+
+    def restore(self, scene, player=True):
+        global camera_x, camera_y, coins_count
+        if player:
+            sprite = scene.player
+            values = self.values
+            n = len(self.player_values)
+            for i, name in enumerate(self.player_values):
+                setattr(sprite, name, values[i])
+            for i, name in enumerate(self.player_flags):
+                setattr(sprite, name, bool(self.flags & 1 << i))
+            sprite.spawn_position = [values[n], values[n + 1]]
+            sprite.set_pos(sprite.x, sprite.y)
+            camera_x, camera_y = values[n + 2], values[n + 3]
+
+        start = 0
+        for battery in scene.group_cannons:
+            end = start + len(battery.rates)
+            battery.set_ticks(self.cannons[start:end])
+            start = end
+
+        for bullet in scene.group_bullets:
+            scene.group_all.remove(bullet)
+        scene.group_bullets.clear()
+        bullets = self.bullets
+        for i in range(0, len(bullets), 4):
+            bullet = BulletSprite(scene, (bullets[i], bullets[i + 1]), 0, 0)
+            bullet.set_pos(bullets[i], bullets[i + 1])
+            bullet.vx, bullet.vy = bullets[i + 2], bullets[i + 3]
+
+        for coin, collected in zip(scene.coins, self.coins):
+            if coin.is_collected() != collected:
+                coin.set_collected(collected)
+        coins_count = self.coins_count
+
+
+class SnapshotRing:
+    # the latest snapshots that fit into the memory budget
+    def __init__(self, budget):
+        self.budget = budget
+        self.snapshots = deque()
+        self.size = 0
+
+    def __len__(self):
+        return len(self.snapshots)
+
+    def clear(self):
+        self.snapshots.clear()
+        self.size = 0
+
+    def push(self, snapshot):
+        self.snapshots.append(snapshot)
+        self.size += snapshot.nbytes()
+        while self.size > self.budget and len(self.snapshots) > 1:
+            self.size -= self.snapshots.popleft().nbytes()
+
+    def pop(self):
+        snapshot = self.snapshots.pop()
+        self.size -= snapshot.nbytes()
+        return snapshot
 
 
 # --------------------------------------------- #
@@ -730,7 +1460,9 @@ class ButtonsScene:
             self.tick()
 
     def tick(self):
-        for event in pygame.event.get():
+        # inactive window waits for events and is drawn only when its content was lost
+        for event in pygame.event.get() if activity.active() else activity.wait():
+            activity.handle(event)
             if event.type == pygame.QUIT:
                 terminate()
             elif event.type == pygame.MOUSEBUTTONDOWN:
@@ -750,6 +1482,10 @@ class ButtonsScene:
                 global window_height, window_width
                 window_width, window_height = (window.get_width(), window.get_height())
 
+        exposed = activity.take_exposed()
+        if not activity.active() and not exposed:
+            return
+
         self.group_all.update()
 
         screen.fill((20,) * 3)
@@ -781,18 +1517,59 @@ class StartScene(ButtonsScene):
 
 
 class GameScene:
-    def __init__(self):
+    # level sprites are drawn in this order
+    sprite_classes = {
+        "black": SimpleWallSprite,
+        "spikes": SpikeSprite,
+        "cannons": CannonBattery,
+        "walls": SimpleWallSprite,
+        "coins": CoinSprite,
+        "shadows": ShadowSprite,
+        "spawns": SpawnSprite,
+        "text": TextSprite,
+        "door": DoorSprite,
+    }
+
+    def __init__(self, recorder=None, replay=None, ghost_path=None, headless=False, dev=False):
+        load_game_images()
         self.running = True
 
-        self.fps_i = 0
+        self.ticks = 0
 
-        self.group_all = Group()
+        self.recorder = recorder
+        self.replay = replay
+        self.ghost_path = ghost_path
+        self.headless = headless
+        # recorded input would not match an edited level
+        self.dev = dev and recorder is None and replay is None
+        self.keys = KeyState(0)
+        self.input = InputQueue(input_key_bits, input_press_bits)
+        self.input.sync(pygame.key.get_pressed())
+
+        # players are drawn first, then level sprites by type, then bullets and particles
+        self.group_all = LayeredGroup(("players", *self.sprite_classes, "others"))
         self.group_walls = Group()
         self.group_spikes = Group()
         self.group_coins = Group()
         self.group_triggers = Group()
+        self.group_cannons = Group()
+        self.lightmap = Lightmap()
+        self.group_bullets = Group()
+        self.coins = Group()
 
         self.player = None
+        self.level_name = None
+        self.level_mtime = None
+        self.entities = {}
+        self.sprite_groups = {}
+        self.wall_rects = {}
+        self.wall_orders = {}
+        self.wall_order = 0
+        self.wall_sprites = {}
+        self.wall_bounds = []
+        self.snapshots = SnapshotRing(snapshot_memory)
+        self.checkpoint = None
+        self.checkpoint_restore = False
 
         self.load_level("level0")
 
@@ -800,37 +1577,248 @@ class GameScene:
         if level_name == "end":
             self.running = False
             return
-        level = load_data("levels/" + level_name + ".json")
+        level = load_level_data(level_name, loose=self.dev)
+        before = take_snapshot() if args.memory_report else None
+        self.level_name = level_name
+        self.level_mtime = get_level_mtime(level_name) if self.dev else None
 
         self.group_all.clear()
+        self.lightmap.clear()
         self.group_walls.clear()
         self.group_spikes.clear()
         self.group_coins.clear()
-        self.fps_i = 0
+        self.group_triggers.clear()
+        self.group_cannons.clear()
+        self.group_bullets.clear()
+        self.coins.clear()
+        self.snapshots.clear()
+        self.checkpoint_restore = False
+
+        ghost_reader = None
+        ghost_section = None
+        if self.ghost_path is not None:
+            ghost_reader = InputReader(self.ghost_path)
+            ghost_section = ghost_reader.find_section(level_name)
+            if ghost_section is None:
+                ghost_reader.close()
+                ghost_reader = None
+
+        if self.replay is not None:
+            section = self.replay.next_section()
+            if section is None or section[0] != level_name:
+                raise ValueError("replay does not match level: " + level_name)
+            random.seed(section[1])
+        elif ghost_section is not None or self.recorder is not None:
+            # with a ghost the level is made the same as in its run, so cannons fire the same
+            seed = ghost_section[1] if ghost_section is not None else random.getrandbits(32)
+            random.seed(seed)
+            if self.recorder is not None:
+                self.recorder.start_level(level_name, seed)
 
         player_pos = self.convert(level["start_pos"])
         self.player = PlayerSprite(self, player_pos)
+        if ghost_reader is not None:
+            GhostSprite(self, player_pos, ghost_reader)
 
         global camera_x, camera_y
         camera_x = player_pos[0] - (width - player_size[0]) // 2
         camera_y = player_pos[1] - (height - player_size[1]) // 2
 
-        sprite_classes = {
-            "black": SimpleWallSprite,
-            "spikes": SpikeSprite,
-            "cannons": create_cannon,
-            "walls": SimpleWallSprite,
-            "coins": CoinSprite,
-            "shadows": ShadowSprite,
-            "spawns": SpawnSprite,
-            "text": TextSprite,
-            "door": DoorSprite,
-        }
-        sprites = level["sprites"]
-        for typ in sprite_classes:
-            for data in sprites[typ]:
-                new_data = list(map(self.convert, data[:3])) + data[3:]
-                sprite_classes[typ](self, *new_data)
+        self.entities = {}
+        self.sprite_groups = {}
+        self.wall_rects = {name: [] for name in wall_merge_sets}
+        self.wall_orders = {name: [] for name in wall_merge_sets}
+        self.wall_order = 0
+        self.wall_sprites = {name: {} for name in wall_merge_sets}
+        self.wall_bounds = []
+        self.change_entities(level["sprites"])
+        if self.dev or args.memory_report:
+            print(f"{level_name}: {len(self.wall_rects['colliders'])} wall rects merged into {len(self.group_walls)}")
+
+        self.checkpoint = WorldSnapshot(self)
+        if before is not None:
+            print(memory_report(snapshot_diff(before, take_snapshot())))
+
+    def change_entities(self, sprites):
+        # entities are matched by their json entries, so only changed entries are removed and created
+        old = self.entities
+        entities = {}
+        added_walls = {typ: [] for typ in wall_types}
+        removed_walls = {typ: [] for typ in wall_types}
+        created = 0
+        kept_entities = []
+        created_sprites = []
+        try:
+            for typ in self.sprite_classes:
+                for data in sprites[typ]:
+                    key = (typ, json.dumps(data))
+                    kept = old.get(key)
+                    if kept:
+                        entity = kept.pop()
+                        kept_entities.append((kept, entity))
+                    else:
+                        entity = self.create_entity(typ, data, created_sprites)
+                        created += 1
+                        if typ in wall_types:
+                            added_walls[typ].append(entity)
+                    entities.setdefault(key, []).append(entity)
+        except Exception:
+            # an invalid entry leaves the old level as it was
+            for sprite in created_sprites:
+                self.remove_sprite(sprite)
+            for kept, entity in reversed(kept_entities):
+                kept.append(entity)
+            raise
+        self.entities = entities
+
+        removed = 0
+        for (typ, _), entities in old.items():
+            for entity in entities:
+                removed += 1
+                if typ in wall_types:
+                    removed_walls[typ].append(entity)
+                    continue
+                for sprite in entity:
+                    self.remove_sprite(sprite)
+
+        self.update_walls(added_walls, removed_walls)
+        return created, removed
+
+    def create_entity(self, typ, data, created_sprites):
+        # walls are kept as rects, other entities as the sprites they made, put into the layer of the type,
+        # sprites are added to created_sprites even when the entity fails half way
+        if typ in wall_types:
+            return pygame.Rect(*map(self.convert, data))
+        groups = (self.group_walls, self.group_spikes, self.group_coins, self.group_triggers,
+                  self.group_cannons, self.coins)
+        sizes = [len(group) for group in groups]
+        others = self.group_all.layers["others"]
+        start = len(others)
+        new_data = list(map(self.convert, data[:3])) + data[3:]
+        try:
+            self.sprite_classes[typ](self, *new_data)
+        finally:
+            sprites = others[start:]
+            self.group_all.set_layer(sprites, typ)
+            # groups of every sprite are remembered, so removing it does not search all of them
+            for group, size in zip(groups, sizes):
+                for sprite in group.sprites[size:]:
+                    self.sprite_groups.setdefault(sprite, []).append(group)
+                    if sprite not in sprites:
+                        sprites.append(sprite)
+            created_sprites += sprites
+        return sprites
+
+    def update_walls(self, added, removed):
+        # walls of one type look the same, so they are drawn merged, and all of them collide merged
+        for typ in wall_types:
+            self.merge_walls(typ, added[typ], removed[typ], lambda pos, size, typ_=typ: self.create_wall(pos, size, typ_),
+                             self.remove_sprite)
+        sources, colliders = self.merge_walls("colliders", sum(added.values(), []), sum(removed.values(), []),
+                                              self.create_collider, self.remove_collider)
+        # level order and bounds with center of every level rect a merged collider touches
+        bounds = [(order, rect.left, rect.top, rect.right, rect.bottom, rect.x + rect.w / 2, rect.y + rect.h / 2)
+                  for order, rect in sources]
+        source_rects = [rect for _, rect in sources]
+        for collider in colliders:
+            collider.sources[:] = [bounds[i] for i in collider.rect.inflate(2, 2).collidelistall(source_rects)]
+
+    def merge_walls(self, name, added, removed, create, remove):
+        # only the rects connected to the changed ones are merged again, other merged rects are kept,
+        # returns the connected rects with their level order and the sprites merged from them
+        if not added and not removed:
+            return [], []
+        rects = self.wall_rects[name]
+        orders = self.wall_orders[name]
+        for rect in removed:
+            i = rects.index(rect)
+            del rects[i]
+            del orders[i]
+        start = len(rects)
+        rects += added
+        orders += range(self.wall_order, self.wall_order + len(added))
+        self.wall_order += len(added)
+
+        connected = set(range(start, len(rects)))
+        found = [rect.inflate(2, 2) for rect in added + removed]
+        while found:
+            new = set()
+            for rect in found:
+                new.update(rect.collidelistall(rects))
+            new -= connected
+            connected |= new
+            found = [rects[i].inflate(2, 2) for i in new]
+
+        merged = self.wall_sprites[name]
+        keys = list(merged)
+        old_keys = {tuple(rect) for rect in removed if tuple(rect) in merged}
+        for rect in [rects[i] for i in connected] + removed:
+            old_keys.update(keys[i] for i in rect.collidelistall(keys))
+        old = {key: merged.pop(key) for key in old_keys}
+
+        connected = sorted(connected)
+        connected_rects = [[[rect.x, rect.y], [rect.w, rect.h]] for rect in (rects[i] for i in connected)]
+        new = self.sync_rects(old, optimize_rects(connected_rects), create, remove)
+        merged.update(new)
+        return [(orders[i], rects[i]) for i in connected], sum(new.values(), [])
+
+    def create_wall(self, pos, size, typ):
+        sprite = SimpleWallSprite(self, pos, size, collide=False)
+        self.group_all.set_layer([sprite], typ)
+        return sprite
+
+    def create_collider(self, pos, size):
+        # bounds for the player collisions are kept in the order of group_walls
+        collider = ColliderRect(self, pos, size)
+        rect = collider.rect
+        self.wall_bounds.append((rect.left, rect.top, rect.right, rect.bottom, collider.sources))
+        return collider
+
+    def remove_collider(self, collider):
+        i = self.group_walls.sprites.index(collider)
+        del self.group_walls.sprites[i]
+        del self.wall_bounds[i]
+
+    def sync_rects(self, old, rects, create, remove):
+        # sprites of merged rects that are still there are kept
+        new = {}
+        for pos, size in rects:
+            key = (*pos, *size)
+            kept = old.get(key)
+            new.setdefault(key, []).append(kept.pop() if kept else create(pos, size))
+        for sprites in old.values():
+            for sprite in sprites:
+                remove(sprite)
+        return new
+
+    def remove_sprite(self, sprite):
+        # coins leave some groups when collected, so the remembered groups are still checked
+        for group in self.sprite_groups.pop(sprite, ()):
+            if sprite in group:
+                group.remove(sprite)
+        if sprite in self.group_all:
+            self.group_all.remove(sprite)
+        if sprite.baked:
+            self.lightmap.remove(sprite)
+
+    def reload_level(self):
+        # dev mode, edits of the level file are applied without restart, player and camera stay
+        mtime = get_level_mtime(self.level_name)
+        if mtime == self.level_mtime:
+            return
+        self.level_mtime = mtime
+        start = perf_counter()
+        try:
+            level = load_level_data(self.level_name, loose=True)
+            created, removed = self.change_entities(level["sprites"])
+        except (OSError, ValueError, KeyError, TypeError) as error:
+            print(f"{self.level_name}: not reloaded, {error!r}")
+            return
+        # old snapshots do not match the new entities, the checkpoint is taken again, it is only a few arrays
+        self.snapshots.clear()
+        self.checkpoint = WorldSnapshot(self)
+        print(f"{self.level_name}: reloaded in {(perf_counter() - start) * 1000:.1f} ms, "
+              f"{created} entities created, {removed} removed")
 
     def convert(self, value):
         typ = type(value)
@@ -843,35 +1831,120 @@ class GameScene:
             self.tick()
 
     def tick(self):
-        clock.tick(fps * fps_tick)
-
+        if self.headless:
+            self.frame()
+            return
+        if not activity.active():
+            self.idle()
+            return
+        pacer.tick(self.input.drain)
+        start = perf_counter()
+        self.frame()
+        frame_time = perf_counter() - start
+        if presenter is not None:
+            # both threads work at once, the slower one limits the frame rate
+            frame_time = max(frame_time, presenter.frame_time)
+        governor.update(frame_time)
+
+    def frame(self):
+        # one rendered frame is fps_tick physics substeps
+        if self.dev and self.ticks % level_watch_every == 0:
+            self.reload_level()
         self.events()
+        states = self.input.frame(fps_tick)
+        for time_ns in self.input.press_times:
+            pacer.mark_input(time_ns)
+        for state in states:
+            if not self.running:
+                return
+            self.step(state)
+        self.draw()
+
+    def idle(self):
+        # simulation is paused and nothing is drawn until the window is active again
+        for event in activity.wait():
+            self.handle_event(event)
+        if activity.take_exposed():
+            # the paused time is not a frame time
+            pacer.reset()
+            self.draw()
+        if activity.active():
+            # keys could change while the window was not active, and time has gone
+            self.input.sync(pygame.key.get_pressed())
+            pacer.reset()
+
+    def step(self, state):
+        if self.rewinding(state):
+            self.snapshots.pop().restore(self)
+            return
+
+        if self.replay is not None:
+            state = self.replay.read()
+            if state is None:
+                self.running = False
+                return
+        if self.recorder is not None:
+            self.recorder.record(state)
+        self.keys = KeyState(state)
+        self.ticks += 1
+
+        if state & EVENT_JUMP:
+            self.player.jump_mercy = jump_mercy
+        if state & EVENT_DASH:
+            self.player.dash()
 
         self.group_all.update()
         self.camera_move()
 
-        self.fps_i = (self.fps_i + 1) % fps_tick
-        if self.fps_i == 0:
+        if self.checkpoint_restore:
+            self.checkpoint_restore = False
+            self.checkpoint.restore(self, player=False)
+        if self.ticks % snapshot_every == 0:
+            self.snapshots.push(WorldSnapshot(self))
+
+    def draw(self):
+        if not self.headless and governor.present():
+            if presenter is not None:
+                snapshot = self.group_all.snapshot()
+                snapshot.inputs = pacer.take_inputs()
+                presenter.submit(snapshot)
+                presenter.flip()
+                return
             screen.fill((20,) * 3)
             self.group_all.draw()
             screen_draw()
+            pacer.presented(pacer.take_inputs())
+
+    def rewinding(self, state):
+        # rewind changes the world outside of recorded input
+        if self.recorder is not None or self.replay is not None:
+            return False
+        return state & input_key_bits[KEY_REWIND] and len(self.snapshots) > 0
 
     def events(self):
-        for event in pygame.event.get():
-            if event.type == pygame.QUIT:
-                terminate()
-            elif event.type == pygame.KEYDOWN:
-                key = event.key
-                if key == KEY_JUMP:
-                    self.player.jump_mercy = jump_mercy
-                elif key == KEY_DASH:
-                    self.player.dash()
-                elif key == pygame.K_g:
-                    global DEBUG
-                    DEBUG = False
-            elif event.type == pygame.VIDEORESIZE:
-                global window_height, window_width
-                window_width, window_height = (window.get_width(), window.get_height())
+        # key events for the player are taken by the input queue, here are the others
+        self.input.drain(exact=False)
+        for event in self.input.take_events():
+            self.handle_event(event)
+
+    def handle_event(self, event):
+        activity.handle(event)
+        if event.type == pygame.QUIT:
+            terminate()
+        elif event.type == pygame.KEYDOWN:
+            key = event.key
+            if key == KEY_PACING_REPORT:
+                print(pacer.report())
+                print("quality:", governor.state())
+            elif key == pygame.K_g:
+                global DEBUG
+                DEBUG = False
+        elif event.type == pygame.WINDOWFOCUSGAINED:
+            # key releases could be lost while window was not focused
+            self.input.sync(pygame.key.get_pressed())
+        elif event.type == pygame.VIDEORESIZE:
+            global window_height, window_width
+            window_width, window_height = (window.get_width(), window.get_height())
 
     def camera_move(self):
         global camera_x, camera_y
@@ -905,8 +1978,8 @@ class SettingScene(ButtonsScene):
     def __init__(self):
         super().__init__()
 
-        ImageSprite(self, (0, 0), screen.copy())
-        fade = pygame.Surface((width, height))
+        ImageSprite(self, (0, 0), surfaces.track(screen.copy(), "SettingScene"))
+        fade = surfaces.track(pygame.Surface((width, height)), "SettingScene")
         fade.set_alpha(200)
         ImageSprite(self, (0, 0), fade)
 
@@ -929,27 +2002,100 @@ class EndScene:
         self.group_all = Group()
         TextSprite(self, [250, 350], 60, "Спасибо за игру")
         TextSprite(self, [250, 100], 30, f"Вы собрали {coins_count}/2 Пончиков")
+        self.redraw = True
 
     def loop(self):
         while True:
             self.tick()
 
     def tick(self):
-        for event in pygame.event.get():
+        # nothing changes here, so the text is drawn only when needed and then events are waited for
+        if self.redraw and activity.shown:
+            self.redraw = False
+            self.group_all.update()
+            screen.fill((20,) * 3)
+            self.group_all.draw()
+            screen_draw()
+
+        for event in activity.wait():
+            activity.handle(event)
             if event.type == pygame.QUIT:
                 terminate()
+            elif event.type == pygame.WINDOWEXPOSED:
+                self.redraw = True
             elif event.type == pygame.VIDEORESIZE:
                 global window_height, window_width
                 window_width, window_height = (window.get_width(), window.get_height())
+                self.redraw = True
 
-        self.group_all.update()
 
-        screen.fill((20,) * 3)
-        self.group_all.draw()
-        screen_draw()
-        clock.tick(fps)
+# --------------------------------------------- #
+# memory accounting
+
+def memory_report(diff=None):
+    return format_report(count_instances((ImageSprite, ColliderRect)), surfaces.pixel_bytes(), diff)
+
+
+def leak_check(rounds):
+    # loading levels again and again must not keep more memory, objects or surfaces
+    tracemalloc.start()
+    game = GameScene(headless=True)
+    for i in range(rounds + leak_check_warmup):
+        if i == leak_check_warmup:
+            take_snapshot()
+            start_memory = tracemalloc.get_traced_memory()[0]
+            start_entities = count_instances((ImageSprite, ColliderRect))
+            start_surfaces = surfaces.pixel_bytes()
+        for level_name in leak_check_levels:
+            game.load_level(level_name)
+
+    take_snapshot()
+    growth = tracemalloc.get_traced_memory()[0] - start_memory
+    entities = count_instances((ImageSprite, ColliderRect))
+    pixels = surfaces.pixel_bytes()
+    errors = []
+    if growth > leak_check_tolerance:
+        errors.append(f"python memory grew by {growth / 1024:.1f} KB")
+    for name, count in entities.items():
+        if count > start_entities[name]:
+            errors.append(f"{name}: {start_entities[name]} -> {count} instances")
+    for origin, (count, size) in pixels.items():
+        start_count, start_size = start_surfaces.get(origin, (0, 0))
+        if size > start_size:
+            errors.append(f"surfaces {origin}: {start_size} -> {size} bytes")
+
+    print(memory_report())
+    print(f"leak check: {rounds} rounds of {', '.join(leak_check_levels)}, memory {growth / 1024:+.1f} KB")
+    for error in errors:
+        print("leak: " + error)
+    return not errors
 
 
+# --------------------------------------------- #
+# command line
+
+arg_parser = argparse.ArgumentParser(description="God of Sky")
+arg_parser.add_argument("--record", metavar="PATH", help="record player input into a file")
+arg_parser.add_argument("--replay", metavar="PATH", help="play recorded input instead of the keyboard")
+arg_parser.add_argument("--ghost", metavar="PATH", help="show recorded input as a ghost player")
+arg_parser.add_argument("--headless", action="store_true", help="no window and no frame limit, needs --replay")
+arg_parser.add_argument("--pipelined", action="store_true", help="draw frames in a separate thread")
+arg_parser.add_argument("--pacing", choices=PACING_POLICIES, default="balanced",
+                        help="frame pacing, precise spins more and uses more CPU")
+arg_parser.add_argument("--timing-report", action="store_true", help="print the first frame time, and frame times and input latency at exit")
+arg_parser.add_argument("--dev", action="store_true", help="reload the level when its file is changed")
+arg_parser.add_argument("--memory-report", action="store_true",
+                        help="print entities, surfaces and memory allocated by each level load")
+arg_parser.add_argument("--leak-check", metavar="ROUNDS", type=int,
+                        help="load all levels many times without a window and fail if memory grows")
+args = arg_parser.parse_args(None if __name__ == "__main__" else [])
+if args.leak_check is not None:
+    os.environ["SDL_VIDEODRIVER"] = "dummy"
+if args.headless:
+    if args.replay is None:
+        arg_parser.error("--headless needs --replay")
+    os.environ["SDL_VIDEODRIVER"] = "dummy"
+
 # --------------------------------------------- #
 # init pygame
 
@@ -957,11 +2103,13 @@ pygame.init()
 pygame.display.set_caption("God of Sky")
 pygame.font.init()
 
+surfaces = SurfaceTracker()
+
 window_width, window_height = 1400, 700
 window = pygame.display.set_mode((window_width, window_height), pygame.RESIZABLE)
 
 width, height = 1000, 500
-screen = pygame.Surface((width, height))
+screen = surfaces.track(pygame.Surface((width, height)), "screen")
 
 clock = pygame.time.Clock()
 
@@ -970,22 +2118,69 @@ camera_x, camera_y = 0, 0
 # --------------------------------------------- #
 # init special consts
 
-COLLIDE_HOOK_UP = 6
-COLLIDE_HOOK_DOWN = 5
-COLLIDE_UP = 4
-COLLIDE_DOWN = 3
-COLLIDE_RIGHT = 2
-COLLIDE_LEFT = 1
+# bits of PlayerSprite.collisions
+COLLIDE_LEFT = 1 << 0
+COLLIDE_RIGHT = 1 << 1
+COLLIDE_DOWN = 1 << 2
+COLLIDE_UP = 1 << 3
+COLLIDE_HOOK_DOWN = 1 << 4
+COLLIDE_HOOK_UP = 1 << 5
+COLLIDE_SIDES = COLLIDE_LEFT | COLLIDE_RIGHT
+COLLIDE_HOOK = COLLIDE_HOOK_DOWN | COLLIDE_HOOK_UP
+
+KEY_REWIND = pygame.K_r
+KEY_PACING_REPORT = pygame.K_F3
+
+input_key_bits = {
+    KEY_UP: 1 << 0,
+    KEY_DOWN: 1 << 1,
+    KEY_LEFT: 1 << 2,
+    KEY_RIGHT: 1 << 3,
+    KEY_JUMP: 1 << 4,
+    KEY_HOOK: 1 << 5,
+    # not recorded, rewind is off while recording
+    KEY_REWIND: 1 << 8,
+}
+input_press_bits = {
+    KEY_JUMP: EVENT_JUMP,
+    KEY_DASH: EVENT_DASH,
+}
 
 # --------------------------------------------- #
 # init consts
 
+wall_types = ("black", "walls")
+# walls of each type are merged for drawing, walls of all types together for collisions
+wall_merge_sets = wall_types + ("colliders",)
+
+FILE_PATH_ATLAS = "atlas.json"
+
+snapshot_every = 6
+snapshot_memory = 1024 * 1024
+# python objects of one snapshot besides the array items: the instance, its attribute dict,
+# headers of its four arrays and two ints, about 750 bytes by sys.getsizeof
+snapshot_overhead = 750
+
+level_watch_every = 30
+
+lightmap_tile = 256
+lightmap_scale = 4
+
+idle_wait_ms = 250
+
+leak_check_levels = ("level0", "level1")
+leak_check_warmup = 2
+leak_check_tolerance = 64 * 1024
+
 max_collide_pixels = 5
 
 fps = 60
 fps_tick = 3
 dt = 1 / fps / fps_tick
 
+governor_smooth_scaling = False
+governor_max_frame_skip = 2
+
 gravity = 1000
 max_gravity = 600
 
@@ -1024,12 +2219,14 @@ yellow_image = pygame.Surface((1, 1))
 yellow_image.fill((100, 100, 0))
 
 void_image = pygame.Surface((1, 1), pygame.SRCALPHA, 32).convert_alpha()
-shadow = load_image("shadow.png")
 
 player_size = (30, 40)
 
 button_size = (64,) * 2
 
+cannon_size = (20, 20)
+cannon_angles = (0, 90, 180, -90)
+
 tile_w = 32
 tile_s = (tile_w,) * 2
 
@@ -1040,19 +2237,29 @@ test_spike_sizes = [
     (tile_w, tile_w / 16 * 6),
     (tile_w, tile_w / 16 * 0),
 ]
-test_spike_anims = [scale(load_image(f"spikes/spike_{i}.png"), tile_s) for i in range(test_spikes_i)]
 
-coin_image = scale(load_image("coin.png"), (25,) * 2)
+coin_fade_time = 255 * dt
 
-spike_image_down = load_image("spike.png")
-spike_image_up = rotate(spike_image_down, 180)
-spike_image_right = rotate(spike_image_down, 90)
-spike_image_left = rotate(spike_image_down, -90)
+game_image_paths = ["shadow.png", "player.png", "coin.png", "spike.png", "cave_ground.png", "bullet.png",
+                    "cannon.png"] + [f"spikes/spike_{i}.png" for i in range(test_spikes_i)]
 
-wall_cave_ground = scale(load_image("cave_ground.png"), (28, 28))
+images = {}
+fonts = {}
+battery_images = {}
+atlas = Atlas(layout_path=FILE_PATH_ATLAS)
+asset_loader = AssetLoader()
+asset_loader.request("buttons/button_play.png")
+asset_loader.request_all(game_image_paths)
 
-cannon_image = scale(load_image("cannon.png"), (20, 20))
-bullet_image = load_image("bullet.png")
+first_frame_time = None
+
+presenter = None
+
+governor = QualityGovernor(1 / fps, governor_smooth_scaling, governor_max_frame_skip)
+
+pacer = FramePacer(fps, args.pacing)
+
+activity = WindowActivity(idle_wait_ms)
 
 # --------------------------------------------- #
 # start game
@@ -1061,8 +2268,38 @@ coins_count = 0
 
 DEBUG = False
 
-StartScene().loop()
-
-GameScene().loop()
-
-EndScene().loop()
+if __name__ == "__main__":
+    if args.leak_check is not None:
+        exit(0 if leak_check(args.leak_check) else 1)
+
+    recorder = None
+    if args.record is not None:
+        recorder = InputRecorder(args.record)
+        atexit.register(recorder.close)
+    replay = None
+    if args.replay is not None:
+        replay = InputReader(args.replay)
+
+    if replay is None:
+        StartScene().loop()
+
+    game = GameScene(recorder, replay, args.ghost, args.headless, args.dev)
+    if args.pipelined and not args.headless:
+        presenter = Presenter()
+    game_start_time = perf_counter()
+    game.loop()
+    if presenter is not None:
+        presenter.stop()
+        print(f"presented {presenter.presented} frames, dropped {presenter.dropped}")
+        presenter = None
+    if args.timing_report and not args.headless:
+        print(pacer.report())
+    if replay is not None:
+        time = perf_counter() - game_start_time
+        print(f"replay: {game.ticks} ticks in {time:.2f} s, {game.ticks / time:.0f} ticks/s")
+    if recorder is not None:
+        recorder.close()
+    if args.headless:
+        terminate()
+
+    EndScene().loop()
@@ -0,0 +1,58 @@
+import gc
+import weakref
+import tracemalloc
+from collections import Counter
+
+
+class SurfaceTracker:
+    # remembers where surfaces were made, without keeping them alive
+    def __init__(self):
+        self.origins = weakref.WeakKeyDictionary()
+
+    def track(self, surface, origin):
+        if surface not in self.origins:
+            self.origins[surface] = origin
+        return surface
+
+    def pixel_bytes(self):
+        # returns {origin: [surfaces count, pixel bytes]}, subsurfaces use pixels of parent
+        result = {}
+        for surface, origin in list(self.origins.items()):
+            stats = result.setdefault(origin, [0, 0])
+            stats[0] += 1
+            if surface.get_parent() is None:
+                w, h = surface.get_size()
+                stats[1] += w * h * surface.get_bytesize()
+        return result
+
+
+def count_instances(base_class):
+    gc.collect()
+    return Counter(type(obj).__name__ for obj in gc.get_objects() if isinstance(obj, base_class))
+
+
+def take_snapshot():
+    if not tracemalloc.is_tracing():
+        tracemalloc.start()
+    gc.collect()
+    return tracemalloc.take_snapshot()
+
+
+def snapshot_diff(before, after, limit=5):
+    stats = after.compare_to(before, "lineno")
+    total = sum(stat.size_diff for stat in stats)
+    return total, stats[:limit]
+
+
+def format_report(entities, surfaces, diff=None):
+    lines = ["entities: " + ", ".join(f"{name}={count}" for name, count in sorted(entities.items()))]
+    total = 0
+    for origin, (count, size) in sorted(surfaces.items(), key=lambda item: -item[1][1]):
+        lines.append(f"  surfaces {origin}: {count}, {size / 1024:.1f} KB")
+        total += size
+    lines.append(f"surfaces total: {total / 1024:.1f} KB")
+    if diff is not None:
+        size, stats = diff
+        lines.append(f"python memory diff: {size / 1024:+.1f} KB")
+        lines += ["  " + str(stat) for stat in stats]
+    return "\n".join(lines)
@@ -0,0 +1,109 @@
+import math
+from time import perf_counter_ns, sleep
+
+# how long before the deadline pacer stops sleeping and starts spinning
+# and how often it polls input while sleeping
+PACING_POLICIES = {
+    "precise": (900_000, 1_000_000),
+    "balanced": (250_000, 2_000_000),
+    "low_cpu": (0, None),
+}
+
+
+class Histogram:
+    def __init__(self, bin_ns=250_000, bins=200):
+        self.bin_ns = bin_ns
+        self.bins = [0] * (bins + 1)
+        self.count = 0
+        self.total = 0
+        self.total_sq = 0
+        self.max = 0
+
+    def add(self, value_ns):
+        self.bins[min(value_ns // self.bin_ns, len(self.bins) - 1)] += 1
+        self.count += 1
+        self.total += value_ns
+        self.total_sq += value_ns * value_ns
+        self.max = max(self.max, value_ns)
+
+    def mean(self):
+        return self.total / self.count if self.count else 0
+
+    def stdev(self):
+        if not self.count:
+            return 0
+        return math.sqrt(max(self.total_sq / self.count - self.mean() ** 2, 0))
+
+    def percentile(self, p):
+        # upper bound of the bin
+        need = self.count * p / 100
+        seen = 0
+        for i, count in enumerate(self.bins):
+            seen += count
+            if count and seen >= need:
+                return (i + 1) * self.bin_ns
+        return 0
+
+    def summary(self):
+        ms = 1_000_000
+        return (f"n={self.count} mean={self.mean() / ms:.2f}ms stdev={self.stdev() / ms:.2f}ms "
+                f"p50={self.percentile(50) / ms:.2f}ms p99={self.percentile(99) / ms:.2f}ms "
+                f"max={self.max / ms:.2f}ms")
+
+
+class FramePacer:
+    def __init__(self, rate, policy="balanced"):
+        self.period = 1_000_000_000 // rate
+        self.spin, self.poll_interval = PACING_POLICIES[policy]
+        self.policy = policy
+        self.deadline = None
+        self.last_frame = None
+        self.frame_times = Histogram()
+        self.latencies = Histogram(bin_ns=1_000_000, bins=250)
+        self.inputs = []
+
+    def reset(self):
+        self.deadline = None
+        self.last_frame = None
+
+    def tick(self, poll=None):
+        # waits until the next deadline, sleeping most of the time and spinning the rest
+        # poll is called between short sleeps, so input gets exact times
+        now = perf_counter_ns()
+        if self.deadline is None or now - self.deadline > self.period:
+            # too late, do not try to catch up
+            self.deadline = now
+        else:
+            wait = self.deadline - now - self.spin
+            while wait > 0:
+                if poll is None or self.poll_interval is None:
+                    sleep(wait / 1_000_000_000)
+                    break
+                poll()
+                sleep(min(wait, self.poll_interval) / 1_000_000_000)
+                wait = self.deadline - perf_counter_ns() - self.spin
+            while perf_counter_ns() < self.deadline:
+                pass
+        self.deadline += self.period
+
+    def mark_input(self, time_ns):
+        self.inputs.append(time_ns)
+
+    def take_inputs(self):
+        inputs = self.inputs
+        self.inputs = []
+        return inputs
+
+    def presented(self, inputs=()):
+        # called right after a frame is flipped with inputs that it is first to show
+        now = perf_counter_ns()
+        if self.last_frame is not None:
+            self.frame_times.add(now - self.last_frame)
+        self.last_frame = now
+        for time_ns in inputs:
+            self.latencies.add(now - time_ns)
+
+    def report(self):
+        return (f"pacing {self.policy}, target {self.period / 1_000_000:.2f}ms period\n"
+                f"frame time: {self.frame_times.summary()}\n"
+                f"input latency: {self.latencies.summary()}")
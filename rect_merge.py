@@ -0,0 +1,55 @@
+def merge_intervals(intervals):
+    # union of [y1, y2) intervals, touching ones are joined
+    merged = []
+    for y1, y2 in sorted(intervals):
+        if merged and y1 <= merged[-1][1]:
+            if y2 > merged[-1][1]:
+                merged[-1][1] = y2
+        else:
+            merged.append([y1, y2])
+    return [tuple(interval) for interval in merged]
+
+
+def merge_rects(rects):
+    # rects are [[x, y], [w, h]] like in the level files
+    # returns a smaller set of rects covering exactly the same area
+    empty = [rect for rect in rects if rect[1][0] <= 0 or rect[1][1] <= 0]
+    rects = [rect for rect in rects if rect not in empty]
+
+    events = {}
+    for i, ((x, y), (w, h)) in enumerate(rects):
+        events.setdefault(x, []).append((i, True))
+        events.setdefault(x + w, []).append((i, False))
+
+    # sweep line from left to right, area between two event x is one slab
+    result = []
+    active = set()
+    opened = {}
+    xs = sorted(events)
+    for x1, x2 in zip(xs, xs[1:] + [None]):
+        for i, start in events[x1]:
+            if start:
+                active.add(i)
+            else:
+                active.discard(i)
+        slab = merge_intervals((rects[i][0][1], rects[i][0][1] + rects[i][1][1]) for i in active)
+
+        # rects with the same y interval as in previous slab continue to grow
+        new_opened = {}
+        for interval in slab:
+            new_opened[interval] = opened.pop(interval, x1)
+        for (y1, y2), start in opened.items():
+            result.append([[start, y1], [x1 - start, y2 - y1]])
+        opened = new_opened
+
+    # join rects that lie on each other with the same x span
+    result.sort(key=lambda rect: (rect[0][0], rect[1][0], rect[0][1]))
+    joined = []
+    for rect in result:
+        if joined:
+            (x, y), (w, h) = joined[-1]
+            if x == rect[0][0] and w == rect[1][0] and y + h == rect[0][1]:
+                joined[-1][1][1] += rect[1][1]
+                continue
+        joined.append(rect)
+    return joined + empty
@@ -0,0 +1,145 @@
+import struct
+
+# one byte per substep: bits 0-5 are held keys, bits 6-7 are key presses
+EVENT_JUMP = 1 << 6
+EVENT_DASH = 1 << 7
+# other bits of input state are not recorded
+RECORDED_BITS = 0xff
+
+MAGIC = b"GOSR"
+VERSION = 2
+# version 1 files are the same, only without deaths
+READ_VERSIONS = (1, 2)
+
+# file: MAGIC, VERSION, then sections
+# section: varint 0, level name, seed, then runs and deaths
+# run: varint count (> 0), state byte
+# death: varint 0, empty level name, the player died at the end of the previous run
+
+
+def write_varint(file, value):
+    while True:
+        byte = value & 0x7f
+        value >>= 7
+        if value:
+            file.write(bytes((byte | 0x80,)))
+        else:
+            file.write(bytes((byte,)))
+            return
+
+
+def read_varint(file):
+    value = 0
+    shift = 0
+    while True:
+        byte = file.read(1)
+        if not byte:
+            if shift:
+                raise ValueError("replay file is cut")
+            return None
+        value |= (byte[0] & 0x7f) << shift
+        if not byte[0] & 0x80:
+            return value
+        shift += 7
+
+
+class InputRecorder:
+    def __init__(self, path):
+        self.file = open(path, 'wb')
+        self.file.write(MAGIC + bytes((VERSION,)))
+        self.state = None
+        self.count = 0
+
+    def start_level(self, level_name, seed):
+        self.flush()
+        name = level_name.encode('utf-8')
+        write_varint(self.file, 0)
+        self.file.write(bytes((len(name),)) + name + struct.pack('<I', seed))
+
+    def record(self, state):
+        state &= RECORDED_BITS
+        if state == self.state:
+            self.count += 1
+            return
+        self.flush()
+        self.state = state
+        self.count = 1
+
+    def record_death(self):
+        self.flush()
+        write_varint(self.file, 0)
+        self.file.write(bytes((0,)))
+
+    def flush(self):
+        if self.count:
+            write_varint(self.file, self.count)
+            self.file.write(bytes((self.state,)))
+        self.state = None
+        self.count = 0
+
+    def close(self):
+        if not self.file.closed:
+            self.flush()
+            self.file.close()
+
+
+class InputReader:
+    def __init__(self, path):
+        self.file = open(path, 'rb')
+        header = self.file.read(len(MAGIC) + 1)
+        if header[:len(MAGIC)] != MAGIC:
+            raise ValueError("not a replay file: " + path)
+        if header[len(MAGIC)] not in READ_VERSIONS:
+            raise ValueError("unsupported replay version: " + path)
+        self.state = 0
+        self.count = 0
+        self.section_start = False
+        self.name_length = 0
+
+    def next_section(self):
+        # returns (level_name, seed) of the next section or None at the end of the file
+        while not self.section_start:
+            self.count = 0
+            if self.read() is None and not self.section_start:
+                return None
+        self.section_start = False
+        name = self.file.read(self.name_length).decode('utf-8')
+        seed, = struct.unpack('<I', self.file.read(4))
+        return name, seed
+
+    def find_section(self, level_name):
+        while True:
+            section = self.next_section()
+            if section is None or section[0] == level_name:
+                return section
+
+    def read(self):
+        # returns state of the next substep or None at the end of the section
+        while self.count == 0:
+            count = read_varint(self.file)
+            if count is None:
+                return None
+            if count == 0:
+                self.name_length = self.file.read(1)[0]
+                if self.name_length == 0:
+                    # deaths are taken by read_death, more deaths at once are skipped
+                    continue
+                self.section_start = True
+                return None
+            self.count = count
+            self.state = self.file.read(1)[0]
+        self.count -= 1
+        return self.state
+
+    def read_death(self):
+        # true if the player died at the end of the substep that was read last
+        if self.count:
+            return False
+        position = self.file.tell()
+        if read_varint(self.file) == 0 and self.file.read(1) == bytes((0,)):
+            return True
+        self.file.seek(position)
+        return False
+
+    def close(self):
+        self.file.close()
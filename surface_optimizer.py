@@ -0,0 +1,72 @@
+import pygame
+
+# how a surface is blitted the fastest way without changing how it looks:
+# opaque is a plain copy, colorkey skips transparent pixels, alpha blends every pixel
+SURFACE_KINDS = ("alpha", "colorkey", "opaque")
+
+# colors tried as a color key, the first one that no opaque pixel has is used
+COLORKEYS = ((255, 0, 255), (0, 255, 255), (255, 255, 0), (1, 2, 3))
+
+
+def classify_surface(surface):
+    if not surface.get_flags() & pygame.SRCALPHA:
+        if surface.get_alpha() is not None and surface.get_alpha() < 255:
+            return "alpha"
+        return "opaque" if surface.get_colorkey() is None else "colorkey"
+    w, h = surface.get_size()
+    opaque = pygame.mask.from_surface(surface, 254).count()
+    if opaque == w * h:
+        return "opaque"
+    if opaque == pygame.mask.from_surface(surface, 0).count():
+        return "colorkey"
+    return "alpha"
+
+
+def pick_colorkey(surface):
+    if surface.get_colorkey() is not None:
+        return tuple(surface.get_colorkey()[:3])
+    opaque = pygame.mask.from_surface(surface, 254)
+    for key in COLORKEYS:
+        if not pygame.mask.from_threshold(surface, key, (1, 1, 1, 255)).overlap_area(opaque, (0, 0)):
+            return key
+    return None
+
+
+def with_colorkey(surface, key):
+    # copy without alpha, transparent pixels are filled with the key
+    result = surface.convert()
+    if surface.get_flags() & pygame.SRCALPHA:
+        transparent = pygame.mask.from_surface(surface, 254)
+        transparent.invert()
+        transparent.to_surface(result, setcolor=key, unsetcolor=None)
+    result.set_colorkey(key)
+    return result
+
+
+def optimize_surface(surface, kind=None):
+    # returns a surface that looks the same and is blitted faster
+    if surface.get_parent() is not None:
+        # subsurfaces share pixels with the parent, so its format is kept
+        return surface
+    if kind is None:
+        kind = classify_surface(surface)
+    if kind == "opaque":
+        return surface.convert()
+    if kind == "colorkey":
+        key = pick_colorkey(surface)
+        if key is None:
+            return surface
+        result = with_colorkey(surface, key)
+        result.set_colorkey(key, pygame.RLEACCEL)
+        return result
+    return surface
+
+
+def alpha_copy(surface):
+    # copy with per-pixel alpha for changing it later, colorkey pixels become transparent
+    if surface.get_flags() & pygame.SRCALPHA:
+        return surface.copy()
+    result = pygame.Surface(surface.get_size(), pygame.SRCALPHA, 32).convert_alpha()
+    result.fill((0, 0, 0, 0))
+    result.blit(surface, (0, 0))
+    return result
@@ -0,0 +1,44 @@
+import pygame
+
+HIDDEN_EVENTS = (pygame.WINDOWMINIMIZED, pygame.WINDOWHIDDEN)
+SHOWN_EVENTS = (pygame.WINDOWRESTORED, pygame.WINDOWSHOWN, pygame.WINDOWMAXIMIZED, pygame.WINDOWEXPOSED)
+
+
+class WindowActivity:
+    # follows focus and visibility of the window, scenes do no work while it is not active
+    def __init__(self, wait_ms=250):
+        self.wait_ms = wait_ms
+        self.focused = True
+        self.shown = True
+        # inactive window has to be drawn again, its content could be lost
+        self.exposed = False
+
+    def handle(self, event):
+        typ = event.type
+        if typ == pygame.WINDOWFOCUSLOST:
+            self.focused = False
+        elif typ == pygame.WINDOWFOCUSGAINED:
+            self.focused = True
+        elif typ in HIDDEN_EVENTS:
+            self.shown = False
+        elif typ in SHOWN_EVENTS:
+            self.shown = True
+            self.exposed = True
+        if self.active():
+            # active windows are drawn every frame anyway
+            self.exposed = False
+
+    def active(self):
+        return self.focused and self.shown
+
+    def take_exposed(self):
+        exposed = self.exposed and self.shown
+        self.exposed = False
+        return exposed
+
+    def wait(self):
+        # blocks until there are events or timeout, instead of polling them every frame
+        event = pygame.event.wait(self.wait_ms)
+        if event.type == pygame.NOEVENT:
+            return []
+        return [event] + pygame.event.get()